@@ -0,0 +1,333 @@
+import asyncio
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+
+from google.adk.agents import Agent
+from google.adk.agents.invocation_context import LlmCallsLimitExceededError
+from google.adk.agents.run_config import RunConfig
+from google.adk.tools import google_search
+from google.adk.sessions import InMemorySessionService
+from google.adk.runners import Runner
+from google import genai
+from google.genai import types
+
+from result_cache import TieredCache, make_key
+from semantic_cache import EMBEDDING_MODEL
+
+
+# Agents, runners and the session service are built once per process. Per-case values reach
+# the instructions through ADK's {key} session-state templating (plain strings only, so numbers
+# are formatted before they go into state), and agent outputs are written back to state with
+# output_key for the agents that follow. Because of that, agents sharing a session do not need
+# each other's turns as history (include_contents="none"), so the image is not re-sent with them.
+
+APP_NAME = "shrushrutai_app"
+USER_ID = "default_user"
+# Sessions normally end with their request; anything older than this is swept up as abandoned
+ADK_SESSION_TTL = 600
+# Model calls allowed per agent run. This only stops runaway function-calling loops:
+# google_search is a built-in, server-side tool on Gemini 2.x and runs inside a single model
+# call, so searches are bounded by ADK_AGENT_TIMEOUT, not by this
+ADK_MAX_LLM_CALLS = int(os.getenv("ADK_MAX_LLM_CALLS", "4"))
+ADK_AGENT_TIMEOUT = float(os.getenv("ADK_AGENT_TIMEOUT", "90"))  # seconds per agent run
+# The evidence search is optional context, so it gets a shorter deadline and is skipped on timeout
+GROUNDING_TIMEOUT = float(os.getenv("GROUNDING_TIMEOUT", "30"))
+GROUNDING_CACHE_TTL = int(os.getenv("GROUNDING_CACHE_TTL", str(24 * 3600)))  # seconds
+GROUNDING_CACHE_DIR = os.getenv("GROUNDING_CACHE_DIR", os.path.join(".cache", "grounding"))
+
+# Agent 1: Verify Medical Agent
+verify_med_agent = Agent(
+    name="Medical_Imaging_Expert",
+    model="gemini-2.5-flash-lite",
+    instruction="""Analyze the given skin image as a very good and expert dermatologist to determine if the skin is healthy or unhealthy.
+- Provide a realistic confidence percentage based on visual clarity and distinct presentation of symptoms. Do NOT force it to be 100%.
+- If healthy, classify it as 'Healthy' and provide the confidence level in percentage.
+- If unhealthy, classify it as 'Unhealthy' and provide the confidence level in percentage.
+- Additionally, determine the skin type as one of the following: 'Dry', 'Oily', or 'Normal'.
+- give answer in strictly <classification>,<confidence score in percent>,<skin type>,<remarks : give some remarks that is in one to two lines> format only.""",
+    description="Expert dermatologist for skin analysis",
+    output_key="verify",
+    # tools=[google_search] # Removed search for verify agent as it's image based
+)
+
+# Agent 2: Unhealthy Skin Agent
+unhealthy_skin_agent = Agent(
+    name="Medical_Imaging_Analysis_Expert",
+    model="gemini-2.5-flash",
+    instruction="""Analyze the given skin image as an expert dermatologist. If the skin appears healthy, classify the prediction as 'Healthy' and provide the confidence level. If unhealthy, use the model output to determine the disease. The prediction by deep learning model is {model_prediction}. If classified as one of the following: 'Actinic Keratosis', 'Atopic Dermatitis', 'Benign Keratosis', 'Dermatofibroma', 'Melanocytic Nevus', 'Melanoma', 'Squamous Cell Carcinoma', 'Tinea Ringworm Candidiasis', or 'Vascular Lesion', assess the likelihood of skin cancer otherwise its a disease. Provide the disease name, confidence level, and remarks. Additionally, include possible symptoms that might be present for further diagnostic evaluation.
+
+Context from previous analysis: {verify}
+
+- give answer in strictly <disease>,<confidence score in percent>,<remarks in two to three lines> format only.
+- If the skin appears healthy, classify it as 'Healthy' and provide the confidence level in percentage.""",
+    description="Diagnoses skin diseases from images",
+    output_key="prediction",
+    include_contents="none",
+    # tools=[google_search]
+)
+
+# Agent 3: Report Agent
+report_agent = Agent(
+    name="Medical_Imaging_Analysis_and_report_generator_Expert",
+    model="gemini-2.5-flash",
+    instruction="""
+        Act as a senior consultant dermatologist. Generate a highly detailed and comprehensive medical report for the following case.
+
+        **Patient Analysis Context:**
+        - Suspected Condition: {primary_class} (Confidence: {primary_confidence})
+        - Secondary Possibility: {secondary_class} (Confidence: {secondary_confidence})
+        - Initial Assessment: {verify}
+        - Current Clinical Evidence: {guidance}
+
+        **Required Report Structure (Use Markdown):**
+
+        ### 1. Detailed Clinical Observations
+        - Describe lesion morphology (size, color, texture, borders).
+        - Note anatomical location and distribution patterns.
+        - Mention any visible signs of inflammation, scaling, or ulceration.
+
+        ### 2. Differential Diagnosis & Reasoning
+        - **Primary Diagnosis**: Explain why {primary_class} is the most likely diagnosis based on visual evidence.
+        - **Differentials**: List 2-3 other conditions that share similar features but are less likely, and explain why.
+
+        ### 3. Pathophysiology (Brief)
+        - Explain the underlying biological mechanism of the primary condition.
+
+        ### 4. Comprehensive Management Plan
+        - **Pharmacological**: Suggest specific generic classes of topical/oral medications (e.g., "Topical corticosteroids", "Antifungals").
+        - **Lifestyle & Hygiene**: Specific advice on skincare, diet, and triggers.
+        - **Home Care**: Actionable steps for the patient.
+
+        ### 5. Prognosis & Follow-up
+        - Expected course of the condition.
+        - Warning signs that require immediate medical attention.
+
+        **Tone:** Professional, clinical, and empathetic.
+        **Format:** strictly markdown, no preamble.
+        """,
+    description="Generates comprehensive medical reports",
+    output_key="report",
+    include_contents="none",
+)
+
+# Agent 4: Jarvis Agent
+jarvis_agent = Agent(
+    name="Medical_Imaging_Expert",
+    model="gemini-2.5-flash",
+    instruction="""You are an AI-powered Dermatology Voice Assistant, designed to provide expert-level support to dermatologists. Your role is to analyze report {report} recommend evidence-based treatments, and guide doctors on the next steps using the latest research and drug discoveries.
+
+The most likely condition the patient could have is **{primary_class}** with a confidence of {primary_confidence}.
+Additionally, there is a minor possibility of **{secondary_class}** with a confidence of {secondary_confidence}.
+
+**Remarks:**
+- **{primary_class}** (Confidence: {primary_confidence}) is the primary concern and should be prioritized for diagnosis and treatment.
+- **{secondary_class}** (Confidence: {secondary_confidence}) may be a secondary condition or share similar symptoms. Further medical evaluation is recommended to rule it out.
+
+### 1️⃣ Understand & Analyze the Case
+- Listen to the doctor's query about a patient's condition.
+- Identify the disease or condition being discussed.
+- Analyze symptoms, affected areas, and disease progression based on the given context or medical report.
+
+### 2️⃣ Provide the Latest Treatment Recommendations
+- Use the current treatment guidelines, FDA-approved drugs, and clinical trials from the evidence summary below.
+- Explain the best available treatment options, including topical, oral, biologic, and advanced therapies.
+- Compare traditional treatments with newly discovered therapies (e.g., AI-assisted skin diagnostics, gene therapy, biologics).
+
+### 3️⃣ Generate a Complete Prescription Plan
+- Suggest medications, dosages, frequency, and possible side effects.
+- Recommend adjunct therapies, such as lifestyle modifications and skincare routines.
+- Warn about contraindications or potential drug interactions.
+
+### 4️⃣ Guide the Doctor on the Next Steps
+- Recommend further diagnostic tests (e.g., biopsy, dermoscopy, blood tests, genetic markers).
+- Suggest patient follow-up intervals and monitoring plans.
+- Provide guidelines for managing severe or resistant cases.
+
+### 5️⃣ Provide Reliable Medical Sources & Links
+- Cite the research-backed sources from the evidence summary (PubMed, JAMA Dermatology, The Lancet, FDA, WHO).
+- Offer links to the latest studies, treatment guidelines, and clinical trials for validation.
+
+Context: {prediction}
+
+Current evidence for {primary_class}: {guidance}
+
+Instructions should be understandable by Dermatologists not for layman audience and make it like a professional advice to doctor like doctor is giving advice to the other doctor and make complete instruction summarize and in 4 to 5 lines pointwise.
+- give answer in proper markdown format.""",
+    description="Provides clinical guidance to dermatologists",
+    include_contents="none",
+)
+
+
+# Agent 5: Evidence agent. The only search the diagnosis needs depends on the disease alone, so it
+# is asked once per class with a fixed question and the answer is shared by report and Jarvis.
+GROUNDING_QUERY = """Summarize current, evidence-based guidance for {disease} for a dermatologist:
+- first-line and advanced treatments (topical, oral, biologic) with typical dosing,
+- recently approved drugs and notable ongoing clinical trials,
+- recommended diagnostic work-up and follow-up.
+Cite trusted sources (PubMed, JAMA Dermatology, The Lancet, FDA, WHO) with links. At most 250 words, markdown."""
+
+grounding_agent = Agent(
+    name="Dermatology_Evidence_Researcher",
+    model="gemini-2.5-flash",
+    instruction="Research the question with Google Search and answer from what you find, as a dermatology consultant.",
+    description="Looks up current treatment evidence for a skin condition",
+    tools=[google_search]
+)
+
+
+def research_agent(name):
+    """Chat (/ans) agent; the web and deep-search variants only differ by name."""
+    return Agent(
+        name=name,
+        model="gemini-2.5-flash",
+        instruction="""Analyze the given question as an expert dermatologist.
+Diagnosis context: {context}.
+- Provide concise answer.
+- Include references.""",
+        description="Expert dermatology assistant",
+        tools=[google_search]
+    )
+
+
+session_service = InMemorySessionService()
+
+
+def _runner(agent):
+    return Runner(agent=agent, app_name=APP_NAME, session_service=session_service)
+
+
+verify_runner = _runner(verify_med_agent)
+unhealthy_runner = _runner(unhealthy_skin_agent)
+report_runner = _runner(report_agent)
+jarvis_runner = _runner(jarvis_agent)
+web_research_runner = _runner(research_agent("Skin_Disease_Research_Web"))
+deep_research_runner = _runner(research_agent("Skin_Disease_Research_Deep"))
+grounding_runner = _runner(grounding_agent)
+
+grounding_cache = TieredCache(cache_dir=GROUNDING_CACHE_DIR, ttl=GROUNDING_CACHE_TTL)
+_grounding = {}  # cache key -> in-flight lookup
+_genai_client = None  # created on first use, once main2 has put the API key in the environment
+
+# What get_agent_response raises when a run hits its deadline or its model-call budget
+AGENT_LIMIT_ERRORS = (asyncio.TimeoutError, LlmCallsLimitExceededError)
+
+_open_sessions = {}  # session_id -> created
+
+
+async def _sweep_abandoned():
+    cutoff = time.time() - ADK_SESSION_TTL
+    for session_id, created in list(_open_sessions.items()):
+        if created < cutoff:
+            _open_sessions.pop(session_id, None)
+            await session_service.delete_session(app_name=APP_NAME, user_id=USER_ID, session_id=session_id)
+
+
+@asynccontextmanager
+async def request_session(state=None):
+    """
+    A fresh session on the shared session service, seeded with `state` and deleted on exit.
+    Every request gets its own id, so concurrent requests for one patient never share history.
+    """
+    await _sweep_abandoned()
+    session_id = uuid.uuid4().hex
+    await session_service.create_session(app_name=APP_NAME, user_id=USER_ID, session_id=session_id, state=state or {})
+    _open_sessions[session_id] = time.time()
+    try:
+        yield session_id
+    finally:
+        _open_sessions.pop(session_id, None)
+        await session_service.delete_session(app_name=APP_NAME, user_id=USER_ID, session_id=session_id)
+
+
+def inline_image(encoded):
+    """Inline image part for the agents, from imaging.encode_for_llm output; build it once per request."""
+    return types.Part.from_bytes(data=encoded["data"], mime_type=encoded["mime_type"])
+
+
+async def get_agent_response(runner: Runner, prompt: str, session_id: str, image: types.Part = None,
+                             max_llm_calls=ADK_MAX_LLM_CALLS, timeout=ADK_AGENT_TIMEOUT) -> str:
+    """
+    Execute agent using its Runner and collect full response text.
+    At most `max_llm_calls` model calls and `timeout` seconds per run; raises one of
+    AGENT_LIMIT_ERRORS when either runs out.
+    """
+    # Create message content, with the case image sent inline when the agent needs to see it
+    parts = [types.Part(text=prompt)]
+    if image is not None:
+        parts.append(image)
+    content = types.Content(role='user', parts=parts)
+    run_config = RunConfig(max_llm_calls=max_llm_calls)
+
+    async def collect():
+        full_response = ""
+        async for event in runner.run_async(user_id=USER_ID, session_id=session_id, new_message=content,
+                                            run_config=run_config):
+            if event.is_final_response():
+                if event.content and event.content.parts:
+                    full_response = event.content.parts[0].text
+                break
+        return full_response
+
+    return await asyncio.wait_for(collect(), timeout)
+
+
+async def _lookup_guidance(disease, key):
+    start = time.perf_counter()
+    try:
+        async with request_session() as session_id:
+            guidance = await get_agent_response(
+                grounding_runner, GROUNDING_QUERY.format(disease=disease), session_id, timeout=GROUNDING_TIMEOUT
+            )
+    except Exception as e:
+        # Not cached, so the next case of this class searches again
+        print(f"Evidence search for {disease} skipped after {time.perf_counter() - start:.1f}s: {e!r}")
+        return ""
+    if guidance:
+        await asyncio.to_thread(grounding_cache.set, key, guidance)
+    print(f"Evidence search for {disease} took {time.perf_counter() - start:.2f}s")
+    return guidance
+
+
+async def clinical_guidance(disease):
+    """
+    Search-grounded treatment evidence for `disease`, cached for GROUNDING_CACHE_TTL per
+    (disease, query template), so common classes do not repeat the search round-trips.
+    Returns "" if the search fails or misses its deadline.
+    """
+    key = make_key("grounding", disease.strip().lower(), GROUNDING_QUERY, grounding_agent.model)
+    cached = await asyncio.to_thread(grounding_cache.get, key)
+    if cached is not None:
+        return cached
+
+    # Concurrent cases of the same class share one search
+    task = _grounding.get(key)
+    if task is None:
+        task = _grounding[key] = asyncio.ensure_future(_lookup_guidance(disease, key))
+        task.add_done_callback(lambda _: _grounding.pop(key, None))
+    return await asyncio.shield(task)
+
+
+def case_state(result_pred, minor_result, verify_content, guidance):
+    """Session state for the prediction, report and Jarvis instructions."""
+    return {
+        "model_prediction": str(result_pred),
+        "primary_class": result_pred["class"],
+        "primary_confidence": f"{result_pred['confidence']:.2f}",
+        "secondary_class": minor_result["class"],
+        "secondary_confidence": f"{minor_result['confidence']:.2f}",
+        "verify": verify_content,
+        "guidance": guidance or "No external evidence available; rely on established clinical knowledge.",
+    }
+
+
+async def embed_query(text):
+    """Embedding for the chat answer cache, with the same API key as the agents."""
+    global _genai_client
+    if _genai_client is None:
+        _genai_client = genai.Client()
+    result = await _genai_client.aio.models.embed_content(
+        model=EMBEDDING_MODEL, contents=text, config=types.EmbedContentConfig(task_type="SEMANTIC_SIMILARITY")
+    )
+    return result.embeddings[0].values
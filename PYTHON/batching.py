@@ -0,0 +1,120 @@
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
+import torch
+
+from model_registry import get_model, device
+
+
+# A batch is closed as soon as it holds BATCH_MAX_SIZE images or
+# BATCH_WINDOW_MS has passed since its first image arrived, whichever comes first.
+BATCH_MAX_SIZE = int(os.getenv("BATCH_MAX_SIZE", "8"))
+BATCH_WINDOW_MS = float(os.getenv("BATCH_WINDOW_MS", "10"))
+
+
+def _settle(resolve, value):
+    try:
+        resolve(value)
+    except InvalidStateError:
+        pass  # already resolved; nothing is waiting on it any more
+
+
+class MicroBatcher:
+    """
+    Collects single-image tensors submitted from many request threads and runs them
+    through the model as one batched forward pass.
+    Each caller gets back a Future resolving to its own row of class probabilities.
+    """
+
+    def __init__(self, model_name, max_batch_size=BATCH_MAX_SIZE, window_ms=BATCH_WINDOW_MS):
+        self.model_name = model_name
+        self.max_batch_size = max_batch_size
+        self.window = window_ms / 1000.0
+        self._queue = queue.Queue()
+        self._batches = 0
+        self._images = 0
+        self._largest = 0
+        self._thread = threading.Thread(target=self._run, name=f"batcher-{model_name}", daemon=True)
+        self._thread.start()
+
+    def submit(self, tensor):
+        """Queues one preprocessed image tensor of shape (C, H, W)."""
+        future = Future()
+        self._queue.put((tensor, future))
+        return future
+
+    def _collect(self):
+        # Block for the first item, then keep filling the batch until the window closes
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            try:
+                self._run_batch(self._collect())
+            except Exception as e:
+                # Never let one bad batch end the thread: every later caller would wait forever
+                print(f"Batcher '{self.model_name}' failed on a batch, continuing: {e}")
+
+    def _run_batch(self, batch):
+        # Callers that gave up (e.g. a cancelled request awaiting via asyncio.wrap_future) have
+        # cancelled their future; drop them. The rest are marked running and can no longer be cancelled.
+        batch = [(tensor, future) for tensor, future in batch if future.set_running_or_notify_cancel()]
+        if not batch:
+            return
+        futures = [future for _, future in batch]
+        try:
+            model = get_model(self.model_name)
+            inputs = torch.stack([tensor for tensor, _ in batch]).to(device)
+            with torch.no_grad():
+                probabilities = torch.softmax(model(inputs), dim=1).cpu()
+        except Exception as e:
+            print(f"Batched inference failed on '{self.model_name}' ({len(batch)} images): {e}")
+            for future in futures:
+                _settle(future.set_exception, e)
+            return
+
+        self._batches += 1
+        self._images += len(batch)
+        self._largest = max(self._largest, len(batch))
+        for i, future in enumerate(futures):
+            _settle(future.set_result, probabilities[i])
+
+    def stats(self):
+        return {
+            "batches": self._batches,
+            "images": self._images,
+            "mean_batch_size": round(self._images / self._batches, 2) if self._batches else 0,
+            "largest_batch": self._largest,
+        }
+
+
+_batchers = {}
+_lock = threading.Lock()
+
+
+def get_batcher(model_name):
+    """Returns the process-wide batcher for `model_name`, starting its worker on first use."""
+    with _lock:
+        if model_name not in _batchers:
+            _batchers[model_name] = MicroBatcher(model_name)
+        return _batchers[model_name]
+
+
+def batch_stats():
+    """Batch sizes each model's batcher has actually run, for checking that batching kicks in."""
+    with _lock:
+        batchers = dict(_batchers)
+    return {name: batcher.stats() for name, batcher in batchers.items()}
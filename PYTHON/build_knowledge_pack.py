@@ -0,0 +1,122 @@
+"""
+Builds the per-disease knowledge pack (see knowledge_pack.py) for every class both CNNs can predict.
+
+    python build_knowledge_pack.py                          # classes missing or built from an older prompt
+    python build_knowledge_pack.py --force                  # rebuild every class
+    python build_knowledge_pack.py --class "Melanoma" --force
+
+Commit the resulting knowledge/knowledge_pack.json; every worker loads it at startup.
+"""
+import argparse
+import json
+import os
+import time
+
+import google.generativeai as genai
+from dotenv import load_dotenv
+
+from gemini_client import generate_with_retry
+from knowledge_pack import KNOWLEDGE_PACK_PATH, PACK_PROMPT_VERSION, PACK_SECTIONS, class_key
+from predict_c import CLASS_NAMES as CNN_CLASSES
+from predict_d import CLASS_NAMES as DENSENET_CLASSES
+from prompts import KNOWLEDGE_PACK_PROMPT
+
+
+BUILD_CONFIG = {
+    "temperature": 0.2,
+    "max_output_tokens": 4096,
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {section: {"type": "string"} for section in PACK_SECTIONS},
+        "required": list(PACK_SECTIONS),
+    },
+}
+
+
+def load_pack(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"classes": {}}
+
+
+def save_pack(path, pack):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    pack["built_at"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    # Written next to the pack and renamed over it, so a running service never reads half a file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(pack, f, indent=1, sort_keys=True, ensure_ascii=False)
+        f.write("\n")
+    os.replace(tmp_path, path)
+
+
+def build_entry(class_name):
+    """One class's sections from a structured Gemini call. Raises ValueError on an unusable response."""
+    response = generate_with_retry(
+        prompt=KNOWLEDGE_PACK_PROMPT.format(disease=class_name),
+        generation_config=BUILD_CONFIG,
+        safety_settings=None
+    )
+    try:
+        sections = json.loads(response.text)
+    except ValueError as e:
+        raise ValueError(f"response is not JSON: {e}")
+    missing = [section for section in PACK_SECTIONS if not str(sections.get(section, "")).strip()]
+    if missing:
+        raise ValueError(f"missing sections {missing}")
+
+    entry = {section: sections[section].strip() for section in PACK_SECTIONS}
+    entry["prompt_version"] = PACK_PROMPT_VERSION
+    return entry
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate the per-disease knowledge pack")
+    parser.add_argument("--class", dest="classes", action="append", default=[], help="only this class (repeatable)")
+    parser.add_argument("--force", action="store_true", help="rebuild entries that are already up to date")
+    parser.add_argument("--output", default=KNOWLEDGE_PACK_PATH)
+    args = parser.parse_args()
+
+    load_dotenv()
+    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+
+    # Both label sets, without duplicates; entries are keyed by the label as the CNN returns it
+    labels = {class_key(name): name for name in [*CNN_CLASSES, *DENSENET_CLASSES]}
+    if args.classes:
+        unknown = [name for name in args.classes if class_key(name) not in labels]
+        if unknown:
+            parser.error(f"not a CNN class: {', '.join(unknown)}")
+        labels = {class_key(name): labels[class_key(name)] for name in args.classes}
+
+    pack = load_pack(args.output)
+    existing = {class_key(name): entry for name, entry in pack["classes"].items()}
+    todo = [
+        name for key, name in labels.items()
+        if args.force or existing.get(key, {}).get("prompt_version") != PACK_PROMPT_VERSION
+    ]
+    print(f"Building {len(todo)} of {len(labels)} classes into {args.output}")
+
+    failed = []
+    for index, name in enumerate(todo, 1):
+        start = time.perf_counter()
+        try:
+            pack["classes"][name] = build_entry(name)
+        except Exception as e:
+            print(f"[{index}/{len(todo)}] {name} failed: {e}")
+            failed.append(name)
+            continue
+        # Saved after every class, so an interrupted build keeps what it already paid for
+        save_pack(args.output, pack)
+        print(f"[{index}/{len(todo)}] {name} ({time.perf_counter() - start:.1f}s)")
+
+    if failed:
+        raise SystemExit(f"{len(failed)} classes failed, run again to retry them")
+
+
+if __name__ == "__main__":
+    main()
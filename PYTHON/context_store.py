@@ -0,0 +1,132 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+# Per-patient diagnosis context lives in diagnoses/{patient_id}
+CONTEXT_COLLECTION = "diagnoses"
+CONTEXT_STORE_ENTRIES = int(os.getenv("CONTEXT_STORE_ENTRIES", "2048"))
+# Bounds how long a context written by another worker process can stay unseen here
+CONTEXT_STORE_TTL = int(os.getenv("CONTEXT_STORE_TTL", "300"))  # seconds
+# Keep cached contexts current with Firestore listeners, so a diagnosis written by another
+# worker shows up right away instead of after CONTEXT_STORE_TTL
+CONTEXT_STORE_LISTEN = os.getenv("CONTEXT_STORE_LISTEN", "0") == "1"
+# diagnosisClass is the primary CNN class; the chat's answer cache is partitioned by it
+CONTEXT_FIELDS = ("imageUrl", "diagnosisClass", "verify", "prediction", "report", "jarvis")
+
+
+def format_context(context):
+    """Chat context text for the /ans prompt, or None when the patient has no diagnosis yet."""
+    if not context:
+        return None
+    return (
+        f"Diagnosis: {context.get('prediction', '')}\n\n"
+        f"Detailed Report: {context.get('report', '')}\n\n"
+        f"Expert Recommendations (Jarvis): {context.get('jarvis', '')}"
+    )
+
+
+class DiagnosisContextStore:
+    """
+    Latest diagnosis context per patient, with an in-process LRU read-through cache in front
+    of Firestore. Writes made in this process update the cache right away (before the
+    document itself is persisted), so the chat sees a new diagnosis immediately. Changes
+    made by other workers are picked up when the entry expires after CONTEXT_STORE_TTL or,
+    with CONTEXT_STORE_LISTEN=1, as soon as they land: every cached patient then gets an
+    on_snapshot listener (on the sync client) that replaces the entry, and entries no longer
+    expire. Listeners are detached when their entry is evicted.
+    """
+
+    def __init__(self, max_entries=CONTEXT_STORE_ENTRIES, ttl=CONTEXT_STORE_TTL, listen=CONTEXT_STORE_LISTEN):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.listen = listen
+        self.db = None
+        self.sync_db = None
+        self._entries = OrderedDict()  # patient_id -> (expires_at, context or None)
+        self._watches = {}
+        self._lock = threading.Lock()
+
+    def bind(self, db, sync_db=None):
+        self.db = db
+        self.sync_db = sync_db
+
+    def document(self, patient_id):
+        return self.db.collection(CONTEXT_COLLECTION).document(patient_id)
+
+    def _remember(self, patient_id, context):
+        expires_at = float("inf") if patient_id in self._watches else time.time() + self.ttl
+        evicted = []
+        with self._lock:
+            self._entries[patient_id] = (expires_at, context)
+            self._entries.move_to_end(patient_id)
+            while len(self._entries) > self.max_entries:
+                evicted_id, _ = self._entries.popitem(last=False)
+                watch = self._watches.pop(evicted_id, None)
+                if watch is not None:
+                    evicted.append(watch)
+        for watch in evicted:
+            watch.unsubscribe()
+
+    def _watch(self, patient_id):
+        def on_snapshot(docs, changes, read_time):
+            for doc in docs:
+                context = doc.to_dict() if doc.exists else None
+                with self._lock:
+                    if patient_id in self._entries:
+                        self._entries[patient_id] = (float("inf"), context)
+
+        with self._lock:
+            if patient_id in self._watches:
+                return
+            self._watches[patient_id] = None  # reserve, so concurrent misses do not attach twice
+        try:
+            watch = self.sync_db.collection(CONTEXT_COLLECTION).document(patient_id).on_snapshot(on_snapshot)
+        except Exception as e:
+            print(f"Context store: could not listen to {patient_id}, using the TTL instead: {e}")
+            with self._lock:
+                self._watches.pop(patient_id, None)
+            return
+        with self._lock:
+            self._watches[patient_id] = watch
+
+    async def get(self, patient_id):
+        with self._lock:
+            entry = self._entries.get(patient_id)
+            if entry is not None and entry[0] > time.time():
+                self._entries.move_to_end(patient_id)
+                return entry[1]
+
+        if self.db is None:
+            return None
+        doc = await self.document(patient_id).get()
+        context = doc.to_dict() if doc.exists else None
+        if self.listen and self.sync_db is not None:
+            self._watch(patient_id)
+        self._remember(patient_id, context)
+        return context
+
+    def put(self, patient_id, context):
+        """Caches a new context; persisting it is up to the caller."""
+        self._remember(patient_id, {field: context.get(field) for field in CONTEXT_FIELDS})
+
+    async def write(self, patient_id, context):
+        """Caches and directly persists a new context."""
+        self.put(patient_id, context)
+        if self.db is None:
+            return
+        await self.document(patient_id).set(
+            {"patientId": patient_id, **{field: context.get(field) for field in CONTEXT_FIELDS}}, merge=True
+        )
+
+
+    def close(self):
+        with self._lock:
+            watches = [watch for watch in self._watches.values() if watch is not None]
+            self._watches.clear()
+        for watch in watches:
+            watch.unsubscribe()
+
+
+context_store = DiagnosisContextStore()
@@ -0,0 +1,67 @@
+import asyncio
+import inspect
+import time
+
+
+def _check_acyclic(stages):
+    # Depth-first walk; a stage seen again while still on the stack is a cycle
+    visiting, done = set(), set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"Dependency cycle through stage '{name}'")
+        if name not in stages:
+            raise ValueError(f"Unknown stage '{name}'")
+        visiting.add(name)
+        for dep in stages[name][0]:
+            visit(dep)
+        visiting.remove(name)
+        done.add(name)
+
+    for name in stages:
+        visit(name)
+
+
+async def run_dag(stages, on_stage_done=None):
+    """
+    Runs a dependency graph of pipeline stages as concurrently as the graph allows.
+
+    `stages` maps a stage name to `(deps, fn)`. `fn` is called with the results of
+    its dependencies as keyword arguments (named after the dependency stages) as soon
+    as those are ready. Coroutine functions are awaited on the event loop, plain
+    functions run in the default thread pool so blocking work overlaps.
+    Returns a dict of stage name -> result. The first failing stage cancels the rest.
+
+    `on_stage_done(name, result)`, if given, is called on the event loop as each
+    stage finishes, so callers can surface partial results before the graph completes.
+    """
+    _check_acyclic(stages)
+    tasks = {}
+
+    async def run_stage(name):
+        deps, fn = stages[name]
+        inputs = {dep: await tasks[dep] for dep in deps}
+        start = time.perf_counter()
+        if inspect.iscoroutinefunction(fn):
+            result = await fn(**inputs)
+        else:
+            result = await asyncio.to_thread(fn, **inputs)
+        print(f"Stage '{name}' finished in {time.perf_counter() - start:.2f}s")
+        if on_stage_done is not None:
+            on_stage_done(name, result)
+        return result
+
+    for name in stages:
+        tasks[name] = asyncio.create_task(run_stage(name))
+
+    try:
+        await asyncio.gather(*tasks.values())
+    except BaseException:
+        for task in tasks.values():
+            task.cancel()
+        await asyncio.gather(*tasks.values(), return_exceptions=True)
+        raise
+
+    return {name: task.result() for name, task in tasks.items()}
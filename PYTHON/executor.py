@@ -0,0 +1,21 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+
+# CPU-bound work (image decode, preprocessing, CNN inference) runs on this bounded
+# pool so it can never starve the event loop or oversubscribe the CPU cores.
+INFERENCE_WORKERS = int(os.getenv("INFERENCE_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+_inference_pool = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix="inference")
+
+
+async def run_cpu_bound(fn, *args, **kwargs):
+    """Runs a blocking, CPU-heavy callable on the inference pool and awaits its result."""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_inference_pool, functools.partial(fn, *args, **kwargs))
+
+
+def shutdown():
+    _inference_pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,181 @@
+"""
+Exports the two CNNs to faster CPU inference backends and checks them against eager PyTorch.
+
+    python export_models.py --backend torchscript onnx quantized --calibration-dir ./calibration
+    python export_models.py --check quantized --calibration-dir ./calibration
+
+The service picks an export up with INFERENCE_BACKEND=torchscript|onnx|quantized
+(see model_registry.py).
+"""
+import argparse
+import os
+import sys
+import time
+
+import torch
+from torch.ao.quantization import get_default_qconfig_mapping, quantize_dynamic
+from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+from image_fetch import decode_image
+from imaging import preprocess_for_models, release_model_inputs
+from model_registry import MODEL_SPECS, EXPORT_DIR, build_eager, exported_path, load_backend
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+def load_calibration_set(calibration_dir, limit):
+    """Model-ready inputs for every image in the directory, keyed by model name."""
+    inputs = {name: [] for name in MODEL_SPECS}
+    files = sorted(f for f in os.listdir(calibration_dir) if f.lower().endswith(IMAGE_EXTENSIONS))[:limit]
+    for file_name in files:
+        with open(os.path.join(calibration_dir, file_name), "rb") as f:
+            image = decode_image(f.read())
+        model_inputs = preprocess_for_models(image)
+        # Clone out of the pooled buffers, which get reused for the next image
+        inputs["cnn"].append(model_inputs.cnn.clone())
+        inputs["densenet"].append(model_inputs.densenet.clone())
+        release_model_inputs(model_inputs)
+    print(f"Loaded {len(files)} calibration images from {calibration_dir}")
+    return inputs
+
+
+def example_input(name):
+    size = MODEL_SPECS[name]["input_size"]
+    return torch.rand(1, 3, size, size)
+
+
+def export_torchscript(name):
+    model = build_eager(name, map_location="cpu")
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example_input(name))
+        frozen = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+    torch.jit.save(frozen, exported_path(name, "torchscript"))
+
+
+def export_onnx(name):
+    model = build_eager(name, map_location="cpu")
+    torch.onnx.export(
+        model,
+        example_input(name),
+        exported_path(name, "onnx"),
+        input_names=["input"],
+        output_names=["logits"],
+        dynamic_axes={"input": {0: "batch"}, "logits": {0: "batch"}},
+        opset_version=17,
+    )
+
+
+def export_quantized(name, calibration):
+    """
+    Static int8 (FX graph mode, conv + linear) when calibration images are available,
+    otherwise dynamic int8 on the linear layers only.
+    """
+    model = build_eager(name, map_location="cpu")
+    example = example_input(name)
+
+    if calibration:
+        prepared = prepare_fx(model, get_default_qconfig_mapping("x86"), example_inputs=(example,))
+        with torch.no_grad():
+            for tensor in calibration:
+                prepared(tensor.unsqueeze(0))
+        quantized = convert_fx(prepared)
+        mode = "static"
+    else:
+        quantized = quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        mode = "dynamic"
+
+    with torch.no_grad():
+        traced = torch.jit.trace(quantized, example)
+    torch.jit.save(traced, exported_path(name, "quantized"))
+    print(f"  {name}: {mode} int8 quantization")
+
+
+def check_parity(name, backend, calibration):
+    """Compares top-1 and confidence of `backend` against the eager model; returns top-1 agreement."""
+    if not calibration:
+        print(f"  {name} [{backend}]: no calibration images, skipped")
+        return 1.0
+
+    eager = build_eager(name, map_location="cpu")
+    candidate = load_backend(name, backend)
+
+    agree = 0
+    max_delta = 0.0
+    timings = {"eager": 0.0, backend: 0.0}
+    with torch.no_grad():
+        for tensor in calibration:
+            batch = tensor.unsqueeze(0)
+            probabilities = {}
+            for label, model in (("eager", eager), (backend, candidate)):
+                start = time.perf_counter()
+                probabilities[label] = torch.softmax(model(batch).float().cpu(), dim=1)[0]
+                timings[label] += time.perf_counter() - start
+
+            reference_class = torch.argmax(probabilities["eager"]).item()
+            candidate_class = torch.argmax(probabilities[backend]).item()
+            agree += reference_class == candidate_class
+            delta = abs(probabilities["eager"][reference_class] - probabilities[backend][reference_class]).item()
+            max_delta = max(max_delta, delta)
+
+    count = len(calibration)
+    agreement = agree / count
+    print(
+        f"  {name} [{backend}]: top-1 agreement {agreement:.1%} ({agree}/{count}), "
+        f"max confidence delta {max_delta:.4f}, "
+        f"latency {timings['eager'] / count * 1000:.1f} ms eager vs {timings[backend] / count * 1000:.1f} ms"
+    )
+    return agreement
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export and verify CPU inference backends for the skin CNNs")
+    parser.add_argument("--backend", nargs="*", default=[], choices=["torchscript", "onnx", "quantized"],
+                        help="backends to export")
+    parser.add_argument("--check", nargs="*", default=[], choices=["torchscript", "onnx", "quantized"],
+                        help="backends to compare against eager PyTorch (exported ones are checked by default)")
+    parser.add_argument("--calibration-dir", help="directory of representative skin images")
+    parser.add_argument("--limit", type=int, default=200, help="max calibration images to use")
+    parser.add_argument("--min-agreement", type=float, default=0.98,
+                        help="fail if top-1 agreement with eager drops below this")
+    args = parser.parse_args()
+
+    if not args.backend and not args.check:
+        parser.error("nothing to do: pass --backend and/or --check")
+
+    calibration = {name: [] for name in MODEL_SPECS}
+    if args.calibration_dir:
+        calibration = load_calibration_set(args.calibration_dir, args.limit)
+
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    for backend in args.backend:
+        print(f"Exporting {backend}...")
+        for name in MODEL_SPECS:
+            if backend == "torchscript":
+                export_torchscript(name)
+            elif backend == "onnx":
+                export_onnx(name)
+            else:
+                export_quantized(name, calibration[name])
+            print(f"  {name} -> {exported_path(name, backend)}")
+
+    to_check = list(dict.fromkeys(args.check or args.backend))
+    if not args.calibration_dir:
+        if args.check:
+            parser.error("--check needs --calibration-dir")
+        print("Skipping parity check (no --calibration-dir)")
+        return
+
+    failed = False
+    for backend in to_check:
+        print(f"Parity check: {backend}")
+        for name in MODEL_SPECS:
+            if check_parity(name, backend, calibration[name]) < args.min_agreement:
+                failed = True
+    if failed:
+        print(f"Parity check failed: top-1 agreement below {args.min_agreement:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+import asyncio
+import random
+import time
+
+from hedging import hedged
+from model_router import router
+from rate_limiter import limiter, estimate_tokens, used_tokens
+
+
+# List of models to try in order of preference (Fastest/Cost-effective -> Most Powerful -> Generic Fallbacks)
+FALLBACK_MODELS = [
+    # "gemini-2.0-flash-lite-preview-02-05",
+    # "gemini-2.0-flash",
+    # "gemini-2.0-flash-lite",
+    # "gemini-2.0-flash-exp",
+    # "gemini-2.5-flash",
+    "gemini-2.5-flash-lite",
+    # "gemini-3-flash-preview",
+    # "gemini-flash-latest",
+    # "gemini-pro-latest"
+]
+
+
+def is_model_unavailable(error):
+    """True for hard errors like 404 (Not Found) or 429 (Quota) that should switch model instead of retrying."""
+    error_str = str(error)
+    return "404" in error_str or "429" in error_str or "Quota exceeded" in error_str or "ResourceExhausted" in error_str
+
+
+def is_quota_error(error):
+    error_str = str(error)
+    return "429" in error_str or "Quota exceeded" in error_str or "ResourceExhausted" in error_str
+
+
+def _on_unavailable(model_name, error):
+    print(f"Model {model_name} failed with Quota/Found error: {error}")
+    if is_quota_error(error):
+        limiter.cooldown(model_name)
+
+
+def _call_sync(lease, call):
+    response = None
+    start = time.perf_counter()
+    try:
+        response = call()
+        router.record_success(lease.model, time.perf_counter() - start)
+        return response
+    except Exception as e:
+        router.record_failure(lease.model, e)
+        raise
+    finally:
+        limiter.release(lease, used_tokens(response))
+
+
+async def _call_async(lease, call):
+    response = None
+    start = time.perf_counter()
+    try:
+        response = await call()
+        router.record_success(lease.model, time.perf_counter() - start)
+        return response
+    except Exception as e:
+        router.record_failure(lease.model, e)
+        raise
+    finally:
+        if response is None:
+            # Cancelled mid-call: no verdict on a half-open model, let someone else probe it
+            router.release_probe(lease.model)
+        limiter.release(lease, used_tokens(response))
+
+
+def generate_with_retry(prompt, generation_config, safety_settings, retries=3, delay=5, system_instruction=None):
+    """
+    Attempts to generate content using a list of fallback models.
+    Candidates are ordered by the model router (circuit breaker state, latency, error rate, cost)
+    and every call takes a slot from the shared rate limiter, which hands out the first of them
+    with RPM/TPM headroom. If a model still fails with a quota error (429) or not found (404),
+    it is dropped and the next one is tried.
+
+    A `system_instruction` (the static part of a prompt template) is sent ahead of `prompt`,
+    so repeated calls with the same template share a prefix Gemini can cache implicitly.
+    """
+    last_exception = None
+    remaining = list(FALLBACK_MODELS)
+    tokens = estimate_tokens(prompt, generation_config, system_instruction)
+
+    while remaining:
+        lease = limiter.acquire_sync(router.order(remaining), tokens)
+        held = lease  # ours to release until _call_sync takes it over
+        try:
+            model_name = lease.model
+            router.on_dispatch(model_name)
+            print(f"Trying model: {model_name}...")
+            model = router.model(model_name, generation_config, safety_settings, system_instruction)
+
+            # Attempt generation with internal retries for transient errors on the SAME model
+            for attempt in range(retries):
+                if attempt > 0:
+                    lease = limiter.acquire_sync([model_name], tokens)
+                held = None
+                try:
+                    return _call_sync(lease, lambda: model.generate_content(prompt))
+                except Exception as e:
+                    # If it's a hard error, break inner loop to switch model
+                    if is_model_unavailable(e):
+                        _on_unavailable(model_name, e)
+                        raise e # Re-raise to trigger model switch
+
+                    # For other errors (500, etc), wait and retry same model
+                    if attempt < retries - 1:
+                        wait_time = delay * (2 ** attempt) + random.uniform(0, 5)
+                        print(f"Transient Error ({e}) on {model_name}. Retrying in {wait_time:.1f}s...")
+                        time.sleep(wait_time)
+                    else:
+                        raise e # Failed all retries for this model
+
+        except Exception as e:
+            last_exception = e
+            remaining.remove(model_name)
+            print(f"Switching from {model_name} due to error...")
+            continue # Try next model in list
+        finally:
+            if held is not None:
+                router.release_probe(held.model)
+                limiter.release(held)
+
+    # If we exhaust all models
+    print(f"All models failed. Last error: {last_exception}")
+    raise last_exception
+
+
+async def generate_with_retry_async(prompt, generation_config, safety_settings, retries=3, delay=5, hedge=None,
+                                    system_instruction=None):
+    """
+    Non-blocking version of generate_with_retry for use inside async handlers.
+    Uses generate_content_async, the limiter's async queue and asyncio.sleep back-offs so a
+    slow, throttled or retrying Gemini call never holds up the event loop.
+
+    Passing a `hedge` label (e.g. "report") opts into hedged requests: a backup call is
+    raced against a slow one within the hedge budget (see hedging.py).
+    """
+    if hedge:
+        return await hedged(
+            hedge, lambda: generate_with_retry_async(
+                prompt, generation_config, safety_settings, retries, delay, system_instruction=system_instruction
+            )
+        )
+
+    last_exception = None
+    remaining = list(FALLBACK_MODELS)
+    tokens = estimate_tokens(prompt, generation_config, system_instruction)
+
+    while remaining:
+        lease = await limiter.acquire(router.order(remaining), tokens)
+        held = lease  # ours to release until _call_async takes it over
+        try:
+            model_name = lease.model
+            router.on_dispatch(model_name)
+            print(f"Trying model: {model_name}...")
+            model = router.model(model_name, generation_config, safety_settings, system_instruction)
+
+            for attempt in range(retries):
+                if attempt > 0:
+                    lease = await limiter.acquire([model_name], tokens)
+                held = None
+                try:
+                    return await _call_async(lease, lambda: model.generate_content_async(prompt))
+                except Exception as e:
+                    if is_model_unavailable(e):
+                        _on_unavailable(model_name, e)
+                        raise e
+
+                    if attempt < retries - 1:
+                        wait_time = delay * (2 ** attempt) + random.uniform(0, 5)
+                        print(f"Transient Error ({e}) on {model_name}. Retrying in {wait_time:.1f}s...")
+                        await asyncio.sleep(wait_time)
+                    else:
+                        raise e
+
+        except Exception as e:
+            last_exception = e
+            remaining.remove(model_name)
+            print(f"Switching from {model_name} due to error...")
+            continue
+        finally:
+            if held is not None:
+                router.release_probe(held.model)
+                limiter.release(held)
+
+    print(f"All models failed. Last error: {last_exception}")
+    raise last_exception
+
+
+async def stream_with_retry_async(prompt, generation_config, safety_settings, system_instruction=None):
+    """
+    Streams generated text chunk by chunk, falling back through FALLBACK_MODELS.
+    A model can only be swapped before its first chunk arrives; once text has been
+    yielded to the caller an error is raised as-is rather than restarting the output.
+    The limiter slot is held until the stream is finished.
+    """
+    last_exception = None
+    remaining = list(FALLBACK_MODELS)
+    tokens = estimate_tokens(prompt, generation_config, system_instruction)
+
+    while remaining:
+        lease = await limiter.acquire(router.order(remaining), tokens)
+        model_name = lease.model
+        started = False
+        response = None
+        start = time.perf_counter()
+        try:
+            router.on_dispatch(model_name)
+            print(f"Streaming from model: {model_name}...")
+            model = router.model(model_name, generation_config, safety_settings, system_instruction)
+            response = await model.generate_content_async(prompt, stream=True)
+            async for chunk in response:
+                if chunk.text:
+                    started = True
+                    yield chunk.text
+            router.record_success(model_name, time.perf_counter() - start)
+            return
+        except Exception as e:
+            router.record_failure(model_name, e)
+            if started:
+                raise
+            if is_model_unavailable(e):
+                _on_unavailable(model_name, e)
+            last_exception = e
+            remaining.remove(model_name)
+            print(f"Switching from {model_name} due to error: {e}")
+            continue
+        finally:
+            router.release_probe(model_name)
+            limiter.release(lease, used_tokens(response))
+
+    print(f"All models failed. Last error: {last_exception}")
+    raise last_exception
@@ -0,0 +1,98 @@
+import asyncio
+import os
+import threading
+import time
+from collections import deque
+
+
+# Fire the backup once the call has run longer than this percentile of recent latencies
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+# Delay used until enough latencies have been seen for the percentile to mean anything
+HEDGE_INITIAL_DELAY = float(os.getenv("HEDGE_INITIAL_DELAY", "15"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", "200"))
+# Hedges may add at most this fraction of extra calls (0 disables hedging)
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.1"))
+# Unused budget saved up for bursts of slow calls, in hedges
+HEDGE_BUDGET_BURST = float(os.getenv("HEDGE_BUDGET_BURST", "5"))
+
+
+class HedgePolicy:
+    """
+    Tracks recent latency per label (e.g. "report", "jarvis") and a shared hedge budget.
+    Each primary call earns HEDGE_BUDGET credit and each hedge spends one, so extra calls
+    stay below that fraction of traffic however slow Gemini gets.
+    """
+
+    def __init__(self, budget=HEDGE_BUDGET):
+        self.budget = budget
+        self._latencies = {}
+        self._credit = 0.0
+        self._primaries = 0
+        self._hedges = 0
+        self._lock = threading.Lock()
+
+    def delay(self, label):
+        with self._lock:
+            samples = sorted(self._latencies.get(label, ()))
+        if len(samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_INITIAL_DELAY
+        return samples[min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE))]
+
+    def record(self, label, latency):
+        with self._lock:
+            window = self._latencies.get(label)
+            if window is None:
+                window = self._latencies[label] = deque(maxlen=HEDGE_WINDOW)
+            window.append(latency)
+
+    def on_primary(self):
+        with self._lock:
+            self._primaries += 1
+            self._credit = min(HEDGE_BUDGET_BURST, self._credit + self.budget)
+
+    def try_spend(self):
+        with self._lock:
+            if self._credit < 1:
+                return False
+            self._credit -= 1
+            self._hedges += 1
+            return True
+
+    def stats(self):
+        with self._lock:
+            return {"primaries": self._primaries, "hedges": self._hedges, "credit": round(self._credit, 2)}
+
+
+policy = HedgePolicy()
+
+
+async def hedged(label, make_call):
+    """
+    Runs make_call() and, if it is still pending after the label's latency percentile and the
+    budget allows, starts a second make_call() and returns whichever succeeds first. The other
+    one is cancelled. If the first to finish fails, the result of the other one is awaited.
+    """
+    start = time.perf_counter()
+    policy.on_primary()
+    primary = asyncio.create_task(make_call())
+    pending = {primary}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=policy.delay(label))
+        if not done and policy.try_spend():
+            print(f"Hedging {label}: no response after {time.perf_counter() - start:.1f}s, sending a backup call")
+            pending.add(asyncio.create_task(make_call()))
+
+        error = None
+        while True:
+            for task in done:
+                if task.exception() is None:
+                    policy.record(label, time.perf_counter() - start)
+                    return task.result()
+                error = task.exception()
+            if not pending:
+                raise error
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in pending:
+            task.cancel()
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+
+import httpx
+from PIL import Image
+
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
+}
+
+# Largest image body we are willing to download (phone photos are a few MB)
+IMAGE_MAX_BYTES = int(os.getenv("IMAGE_MAX_BYTES", str(20 * 1024 * 1024)))
+# Memory budget for bodies kept around to answer 304 Not Modified revalidations
+IMAGE_CACHE_MAX_MB = int(os.getenv("IMAGE_CACHE_MAX_MB", "64"))
+# Largest input resolution any model needs; JPEGs are decoded straight down towards it
+DECODE_SIZE = int(os.getenv("IMAGE_DECODE_SIZE", "512"))
+
+_client = None
+
+
+class ImageTooLargeError(httpx.HTTPError):
+    pass
+
+
+class _ValidatorCache:
+    """LRU of url -> (etag, last_modified, body), bounded by total body size."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        with self._lock:
+            entry = self._entries.get(url)
+            if entry is not None:
+                self._entries.move_to_end(url)
+            return entry
+
+    def put(self, url, etag, last_modified, body):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(url, None)
+            if old is not None:
+                self._size -= len(old[2])
+            self._entries[url] = (etag, last_modified, body)
+            self._size += len(body)
+            while self._size > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._size -= len(evicted[2])
+
+
+_validators = _ValidatorCache(IMAGE_CACHE_MAX_MB * 1024 * 1024)
+
+
+def get_client():
+    """Shared async HTTP client so image fetches reuse pooled keep-alive connections."""
+    global _client
+    if _client is None:
+        _client = httpx.AsyncClient(
+            headers=HEADERS,
+            timeout=10,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16, keepalive_expiry=60),
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+
+async def _download(image_url):
+    cached = _validators.get(image_url)
+    headers = {}
+    if cached is not None:
+        etag, last_modified, _ = cached
+        if etag:
+            headers["If-None-Match"] = etag
+        if last_modified:
+            headers["If-Modified-Since"] = last_modified
+
+    async with get_client().stream("GET", image_url, headers=headers) as response:
+        if response.status_code == 304 and cached is not None:
+            print(f"Image not modified, reusing cached body: {image_url}")
+            return cached[2]
+        response.raise_for_status()
+
+        declared = response.headers.get("Content-Length")
+        if declared is not None and declared.isdigit() and int(declared) > IMAGE_MAX_BYTES:
+            raise ImageTooLargeError(f"Image is {declared} bytes, limit is {IMAGE_MAX_BYTES}")
+
+        # Content-Length can be missing or wrong, so enforce the limit while reading too
+        buffer = bytearray()
+        async for chunk in response.aiter_bytes():
+            buffer.extend(chunk)
+            if len(buffer) > IMAGE_MAX_BYTES:
+                raise ImageTooLargeError(f"Image exceeds the {IMAGE_MAX_BYTES} byte limit")
+
+        body = bytes(buffer)
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if etag or last_modified:
+            _validators.put(image_url, etag, last_modified, body)
+        return body
+
+
+async def fetch_image_bytes(image_url, max_retries=3):
+    """
+    Downloads the image body, retrying transient failures without blocking the event loop.
+    Revalidates previously seen URLs with ETag / If-Modified-Since and refuses bodies
+    larger than IMAGE_MAX_BYTES.
+    """
+    for attempt in range(max_retries):
+        try:
+            return await _download(image_url)
+        except ImageTooLargeError:
+            raise
+        except httpx.HTTPError as e:
+            if attempt == max_retries - 1:
+                print(f"Failed to fetch image after {max_retries} attempts: {e}")
+                raise
+            print(f"Image fetch failed (attempt {attempt+1}/{max_retries}). Retrying...")
+            await asyncio.sleep(1)
+
+
+def decode_image(image_bytes, size=DECODE_SIZE):
+    """
+    Decodes to RGB. For JPEGs, Image.draft lets libjpeg decode at 1/2, 1/4 or 1/8 scale
+    while staying at least `size` pixels on each side, so a 12 MP phone photo never gets
+    fully decoded just to be resized to model resolution.
+    """
+    image = Image.open(BytesIO(image_bytes))
+    image.draft("RGB", (size, size))
+    return image.convert("RGB")
@@ -0,0 +1,105 @@
+import os
+import threading
+from io import BytesIO
+from typing import NamedTuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+from model_registry import MODEL_SPECS
+
+
+# Gemini bills images up to 768x768 as a single tile, so larger uploads only add bytes
+LLM_IMAGE_MAX_SIDE = int(os.getenv("LLM_IMAGE_MAX_SIDE", "768"))
+LLM_IMAGE_QUALITY = int(os.getenv("LLM_IMAGE_QUALITY", "85"))
+
+
+def encode_for_llm(image: Image.Image, max_side=LLM_IMAGE_MAX_SIDE, quality=LLM_IMAGE_QUALITY):
+    """
+    Re-encodes the decoded image as a compact in-memory JPEG no larger than `max_side`
+    and returns it as an inline image part ({"mime_type", "data"}) that every agent
+    in a request can share.
+    """
+    if max(image.size) > max_side:
+        image = image.copy()
+        image.thumbnail((max_side, max_side), Image.Resampling.LANCZOS)
+
+    buffer = BytesIO()
+    image.save(buffer, format="JPEG", quality=quality, optimize=True)
+    return {"mime_type": "image/jpeg", "data": buffer.getvalue()}
+
+
+# ImageNet statistics the DenseNet was trained with, folded into one multiply-subtract:
+# (x / 255 - mean) / std == x * (1 / (255 * std)) - mean / std
+_IMAGENET_MEAN = torch.tensor([0.485, 0.456, 0.406]).view(3, 1, 1)
+_IMAGENET_STD = torch.tensor([0.229, 0.224, 0.225]).view(3, 1, 1)
+_DENSENET_SCALE = 1.0 / (255.0 * _IMAGENET_STD)
+_DENSENET_SHIFT = _IMAGENET_MEAN / _IMAGENET_STD
+
+CNN_SIZE = MODEL_SPECS["cnn"]["input_size"]
+DENSENET_SIZE = MODEL_SPECS["densenet"]["input_size"]
+
+
+class ModelInputs(NamedTuple):
+    cnn: torch.Tensor       # (3, 128, 128), values in [0, 1]
+    densenet: torch.Tensor  # (3, 512, 512), ImageNet-normalized
+
+
+class _BufferPool:
+    """
+    Reuses the float32 input tensors between requests instead of allocating ~3 MB per image.
+    A buffer set is checked out for the whole time its tensors may still be read by a batcher,
+    and handed back with release_model_inputs.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._free = []
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+        return ModelInputs(
+            cnn=torch.empty(3, CNN_SIZE, CNN_SIZE),
+            densenet=torch.empty(3, DENSENET_SIZE, DENSENET_SIZE),
+        )
+
+    def release(self, inputs):
+        with self._lock:
+            if len(self._free) < self.capacity:
+                self._free.append(inputs)
+
+
+_buffer_pool = _BufferPool(capacity=int(os.getenv("PREPROCESS_BUFFERS", "16")))
+
+
+def _fill(buffer, image):
+    # HWC uint8 -> CHW float32 straight into the preallocated buffer
+    pixels = torch.from_numpy(np.array(image, dtype=np.uint8))
+    buffer.copy_(pixels.permute(2, 0, 1))
+    return buffer
+
+
+def preprocess_for_models(image: Image.Image):
+    """
+    Builds both model inputs from one decoded image in a single pass.
+    The image is resized once to the DenseNet resolution and that result is downsampled
+    again for the small CNN (a two-level pyramid), then both are converted with vectorized
+    in-place tensor ops into pooled buffers.
+    """
+    inputs = _buffer_pool.acquire()
+
+    large = image.resize((DENSENET_SIZE, DENSENET_SIZE), Image.Resampling.BILINEAR)
+    small = large.resize((CNN_SIZE, CNN_SIZE), Image.Resampling.BILINEAR)
+
+    _fill(inputs.cnn, small).div_(255.0)
+    _fill(inputs.densenet, large).mul_(_DENSENET_SCALE).sub_(_DENSENET_SHIFT)
+    return inputs
+
+
+def release_model_inputs(inputs):
+    """Returns buffers from preprocess_for_models once no model will read them again."""
+    _buffer_pool.release(inputs)
@@ -0,0 +1,76 @@
+import json
+import os
+
+from prompts import KNOWLEDGE_PACK_PROMPT, REPORT_PACK_SECTIONS, JARVIS_FROM_PACK, case_fields
+from result_cache import content_hash, make_key
+
+
+# Built offline by build_knowledge_pack.py; set KNOWLEDGE_PACK=0 to always use the LLM instead
+KNOWLEDGE_PACK = os.getenv("KNOWLEDGE_PACK", "1") == "1"
+KNOWLEDGE_PACK_PATH = os.getenv("KNOWLEDGE_PACK_PATH", os.path.join("knowledge", "knowledge_pack.json"))
+PACK_SECTIONS = ("pathophysiology", "management", "prognosis", "treatment", "follow_up", "references")
+# Entries built from another prompt or section list are rebuilt by the next build
+PACK_PROMPT_VERSION = make_key(KNOWLEDGE_PACK_PROMPT, PACK_SECTIONS)[:12]
+
+
+def class_key(class_name):
+    return " ".join(class_name.lower().split())
+
+
+class KnowledgePack:
+    """
+    Case-independent report sections and Jarvis advice per CNN class, read once at startup.
+    Classes missing from the pack (or every class, if there is no pack) keep using the LLM.
+    `version` is a hash of the pack file, part of the report and Jarvis cache keys so a
+    rebuilt pack does not serve reports stitched from the old one.
+    """
+
+    def __init__(self, path=KNOWLEDGE_PACK_PATH, enabled=KNOWLEDGE_PACK):
+        self.path = path
+        self.enabled = enabled
+        self.entries = {}
+        self.version = None
+
+    def load(self):
+        if not self.enabled:
+            return
+        try:
+            with open(self.path, "rb") as f:
+                raw = f.read()
+            pack = json.loads(raw)
+        except FileNotFoundError:
+            print(f"Knowledge pack {self.path} not found, report and Jarvis use the LLM for every class")
+            return
+        except ValueError as e:
+            print(f"Knowledge pack {self.path} is unreadable, ignoring it: {e}")
+            return
+
+        self.entries = {
+            class_key(name): entry for name, entry in pack.get("classes", {}).items()
+            if all(entry.get(section) for section in PACK_SECTIONS)
+        }
+        self.version = content_hash(raw)[:12]
+        stale = sum(entry.get("prompt_version") != PACK_PROMPT_VERSION for entry in self.entries.values())
+        print(
+            f"Knowledge pack {self.version} loaded with {len(self.entries)} classes"
+            + (f" ({stale} built from an older prompt, rebuild with build_knowledge_pack.py)" if stale else "")
+        )
+
+    def entry(self, class_name):
+        """The pack entry for a CNN class, or None if the LLM has to write those sections."""
+        if not self.enabled:
+            return None
+        return self.entries.get(class_key(class_name))
+
+
+def report_tail(entry):
+    """The class's reference sections, appended after the LLM's case-specific report sections."""
+    return f"\n\n{REPORT_PACK_SECTIONS.format(**entry)}"
+
+
+def pack_jarvis(entry, result_pred, minor_result):
+    """Jarvis advice for a class covered by the pack, without an LLM call."""
+    return JARVIS_FROM_PACK.format(**case_fields(result_pred, minor_result), **entry)
+
+
+knowledge_pack = KnowledgePack()
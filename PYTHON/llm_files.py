@@ -0,0 +1,103 @@
+import asyncio
+import os
+import threading
+import time
+from collections import OrderedDict
+from io import BytesIO
+
+import google.generativeai as genai
+
+from result_cache import result_cache, make_key
+
+
+# Upload each image to the Gemini Files API once and send a file reference instead of inline bytes
+GEMINI_FILE_UPLOADS = os.getenv("GEMINI_FILE_UPLOADS", "1") == "1"
+# The Files API deletes uploads after 48 hours; stop handing out a reference well before that
+GEMINI_FILE_TTL = int(os.getenv("GEMINI_FILE_TTL", str(46 * 3600)))
+GEMINI_FILE_MEMORY_ENTRIES = int(os.getenv("GEMINI_FILE_MEMORY_ENTRIES", "1024"))
+
+
+class _FileRefs:
+    """LRU of image hash -> (expires_at, file_data part) for images already uploaded."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, image_hash):
+        with self._lock:
+            entry = self._entries.get(image_hash)
+            if entry is None:
+                return None
+            if entry[0] <= time.time():
+                del self._entries[image_hash]
+                return None
+            self._entries.move_to_end(image_hash)
+            return entry[1]
+
+    def put(self, image_hash, expires_at, part):
+        with self._lock:
+            self._entries[image_hash] = (expires_at, part)
+            self._entries.move_to_end(image_hash)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+_refs = _FileRefs(GEMINI_FILE_MEMORY_ENTRIES)
+_uploads = {}  # image hash -> in-flight upload task
+
+
+def _cache_key(image_hash):
+    return make_key("gemini_file", image_hash)
+
+
+def _upload(image_part, image_hash):
+    uploaded = genai.upload_file(
+        BytesIO(image_part["data"]),
+        mime_type=image_part["mime_type"],
+        display_name=f"skin-{image_hash[:16]}"
+    )
+    return {"file_data": {"mime_type": uploaded.mime_type, "file_uri": uploaded.uri}}
+
+
+async def _upload_and_remember(image_part, image_hash):
+    start = time.perf_counter()
+    part = await asyncio.to_thread(_upload, image_part, image_hash)
+    expires_at = time.time() + GEMINI_FILE_TTL
+    _refs.put(image_hash, expires_at, part)
+    # Also on disk, so other workers and restarts reuse the upload too
+    await asyncio.to_thread(result_cache.set, _cache_key(image_hash), {"expires_at": expires_at, "part": part})
+    print(f"Uploaded image {image_hash[:12]} to the Files API in {time.perf_counter() - start:.2f}s")
+    return part
+
+
+async def shared_image_part(image_part, image_hash):
+    """
+    Returns a Files API reference for the image, uploading it on first use. Every agent of a
+    request, and every re-analysis of the same image within GEMINI_FILE_TTL, then sends the
+    short reference instead of the JPEG bytes. Falls back to the inline part if uploads are
+    disabled or the upload fails.
+    """
+    if not GEMINI_FILE_UPLOADS:
+        return image_part
+
+    part = _refs.get(image_hash)
+    if part is not None:
+        return part
+
+    stored = await asyncio.to_thread(result_cache.get, _cache_key(image_hash))
+    if stored is not None and stored["expires_at"] > time.time():
+        _refs.put(image_hash, stored["expires_at"], stored["part"])
+        return stored["part"]
+
+    # Agents of the same request ask concurrently; only the first one uploads
+    task = _uploads.get(image_hash)
+    if task is None:
+        task = _uploads[image_hash] = asyncio.ensure_future(_upload_and_remember(image_part, image_hash))
+        task.add_done_callback(lambda _: _uploads.pop(image_hash, None))
+    try:
+        return await asyncio.shield(task)
+    except Exception as e:
+        print(f"Files API upload failed, sending the image inline: {e}")
+        return image_part
@@ -1,30 +1,58 @@
-from predict_d import predict_d
-from predict_c import predict_c
-from PIL import Image
+from predict_d import predict_d_async
+from predict_c import predict_c_async
+from model_registry import warmup, model_version
+from dag import run_dag
+from prompts import (
+    VERIFY_PROMPT, PREDICTION_PROMPT, REPORT_INSTRUCTIONS, REPORT_CASE_INSTRUCTIONS, REPORT_CASE,
+    JARVIS_INSTRUCTIONS, JARVIS_CASE,
+    SINGLE_SHOT_PROMPT, ANS_PROMPT, case_fields
+)
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
 import os
-import requests
-from io import BytesIO
+import time
+import json
+import asyncio
+import httpx
 from pydantic import BaseModel
 from dotenv import load_dotenv
-from typing import Optional
+from typing import List, Literal, Optional
 
 import firebase_admin
 from firebase_admin import credentials
 from firebase_admin import firestore
+from firebase_admin import firestore_async
 
 import google.generativeai as genai
 
+from gemini_client import FALLBACK_MODELS, generate_with_retry_async, stream_with_retry_async
+from model_router import router
+from result_cache import result_cache, content_hash, make_key
+from image_fetch import fetch_image_bytes, decode_image, close_client
+from llm_files import shared_image_part
+from imaging import encode_for_llm, preprocess_for_models, release_model_inputs
+from batching import batch_stats
+from executor import INFERENCE_WORKERS, run_cpu_bound, shutdown as shutdown_executor
+from stage_engine import Stage, run_pipeline
+from write_behind import report_writer
+from context_store import context_store, format_context
+from patient_cache import patient_cache
+from knowledge_pack import knowledge_pack, report_tail, pack_jarvis
+from semantic_cache import EMBEDDING_MODEL, answer_cache
+
 load_dotenv()
 
 # Firebase Initialization
 cred_path = os.path.join("..", "backend", "serviceAccountKey.json")
+# Both stay None if Firebase cannot be initialized; the Firestore-backed parts are then skipped
+db = adb = None
 try:
     cred = credentials.Certificate(cred_path)
     if not firebase_admin._apps:
         firebase_admin.initialize_app(cred)
     db = firestore.client()
+    adb = firestore_async.client()
     print("Firebase Admin Initialized")
 except Exception as e:
     print(f"Error initializing Firebase: {e}")
@@ -32,75 +60,22 @@ except Exception as e:
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 genai.configure(api_key=GOOGLE_API_KEY)
 
-# Aggressive retry implementation for API calls
-import time
-import random
-
-# List of models to try in order of preference (Fastest/Cost-effective -> Most Powerful -> Generic Fallbacks)
-FALLBACK_MODELS = [
-    # "gemini-2.0-flash-lite-preview-02-05", 
-    # "gemini-2.0-flash",                     
-    # "gemini-2.0-flash-lite",
-    # "gemini-2.0-flash-exp",
-    # "gemini-2.5-flash",         
-    "gemini-2.5-flash-lite",    
-    # "gemini-3-flash-preview",   
-    # "gemini-flash-latest",
-    # "gemini-pro-latest"
-]
-
-def generate_with_retry(prompt, generation_config, safety_settings, retries=3, delay=5):
-    """
-    Attempts to generate content using a list of fallback models.
-    If a model fails with a quota error (429) or not found (404), it moves to the next model.
-    """
-    last_exception = None
-    
-    for model_name in FALLBACK_MODELS:
-        print(f"Trying model: {model_name}...")
-        try:
-            # Instantiate model
-            model = genai.GenerativeModel(
-                model_name=model_name,
-                generation_config=generation_config,
-                safety_settings=safety_settings
-            )
-            
-            # Attempt generation with internal retries for transient errors on the SAME model
-            for attempt in range(retries):
-                try:
-                    return model.generate_content(prompt)
-                except Exception as e:
-                    error_str = str(e)
-                    # If it's a hard error like 404 (Not Found) or 429 (Quota), break inner loop to switch model
-                    if "404" in error_str or "429" in error_str or "Quota exceeded" in error_str or "ResourceExhausted" in error_str:
-                         print(f"Model {model_name} failed with Quota/Found error: {e}")
-                         raise e # Re-raise to trigger model switch
-                    
-                    # For other errors (500, etc), wait and retry same model
-                    if attempt < retries - 1:
-                        wait_time = delay * (2 ** attempt) + random.uniform(0, 5)
-                        print(f"Transient Error ({e}) on {model_name}. Retrying in {wait_time:.1f}s...")
-                        time.sleep(wait_time)
-                    else:
-                        raise e # Failed all retries for this model
-            
-        except Exception as e:
-            last_exception = e
-            print(f"Switching from {model_name} due to error...")
-            continue # Try next model in list
-            
-    # If we exhaust all models
-    print(f"All models failed. Last error: {last_exception}")
-    raise last_exception
 
 class Id(BaseModel):
     obj_id: str
     imageUrl: Optional[str] = None
+    use_cache: bool = True
+    # "agents" (four Gemini calls) or "single" (one structured call); defaults to PIPELINE_MODE
+    mode: Optional[Literal["agents", "single"]] = None
+
+class BatchRequest(BaseModel):
+    items: List[Id]
 
 class Query(BaseModel):
     query: str
     deep_search: bool = False
+    # Patient whose diagnosis the question is about; without it the chat has no patient context
+    obj_id: Optional[str] = None
 
 app = FastAPI()
 app.add_middleware(
@@ -111,345 +86,664 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+
+@app.on_event("startup")
+def load_models():
+    # Load and warm up both CNNs once per worker instead of on every /predict
+    warmup()
+    knowledge_pack.load()
+    answer_cache.bind(embed_query)
+
+
+@app.on_event("startup")
+async def start_report_writer():
+    if adb is None:
+        # Reports still go to the local spool and are written by the next start with Firestore
+        print("Firestore unavailable: write-behind, patient lookups and stored chat context are disabled")
+        return
+    # Also flushes reports left in the spool by a previous run
+    report_writer.start(adb)
+    context_store.bind(adb, db)
+    patient_cache.bind(adb, db)
+
+
+@app.on_event("shutdown")
+async def release_resources():
+    await report_writer.drain()
+    patient_cache.close()
+    context_store.close()
+    await close_client()
+    shutdown_executor()
+
+
 @app.get("/")
 def read_root():
     return {"message": "Welcome to the ShrushrutAI"}
 
-@app.post("/predict")
-async def classify_image(req: Id):
-    obj_id = req.obj_id
 
-    # Priority 1: Use specific image URL
-    if req.imageUrl and req.imageUrl.strip():
-        image_url = req.imageUrl
-        print(f"Using provided image URL: {image_url}")
-    else:
-        # Priority 2: Fallback to latest
-        def get_latest_skin_image(obj_id: str):
-            try:
-                # Fetch patient document from Firestore
-                doc_ref = db.collection("patients").document(obj_id)
-                doc = doc_ref.get()
-                
-                if doc.exists:
-                    data = doc.to_dict()
-                    skin_images = data.get("skinImages", [])
-                    
-                    if skin_images and len(skin_images) > 0:
-                        image_url = skin_images[-1] # Get the last added image
-                        print(f"Found image URL: {image_url}")
-                        return image_url
-                    else:
-                        print("No images found in patient record")
-                        return None
-                else:
-                    print("Patient document not found")
-                    return None
-            except Exception as e:
-                print(f"Error fetching from Firestore: {e}")
-                return None
-
-        image_url = get_latest_skin_image(obj_id)
-    
-    if not image_url:
-        raise HTTPException(status_code=404, detail="Image not found")
+@app.get("/models/health")
+def models_health():
+    """Circuit breaker state, latency and error-rate EWMA of every Gemini model tried so far."""
+    return router.stats()
+
+
+@app.get("/inference/stats")
+def inference_stats():
+    """Batch sizes the CNN micro-batchers have run so far in this worker."""
+    return batch_stats()
+
+
+@app.get("/persistence/stats")
+def persistence_stats():
+    """Depth and health of the write-behind queue for diagnosis reports."""
+    return report_writer.stats()
+
+
+GENERATION_CONFIG = {
+    "temperature": 0.4,
+    "top_p": 1,
+    "top_k": 32,
+    "max_output_tokens": 1024,
+}
+
+SAFETY_SETTINGS = [
+    {
+        "category": "HARM_CATEGORY_HARASSMENT",
+        "threshold": "BLOCK_NONE"
+    },
+    {
+        "category": "HARM_CATEGORY_HATE_SPEECH",
+        "threshold": "BLOCK_NONE"
+    },
+    {
+        "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
+        "threshold": "BLOCK_NONE"
+    },
+    {
+        "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
+        "threshold": "BLOCK_NONE"
+    },
+]
 
-    try:
-        # Enhanced image fetching with headers and retry
-        headers = {
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
-        }
-        
-        max_retries = 3
-        for attempt in range(max_retries):
-            try:
-                response = requests.get(image_url, headers=headers, timeout=10)
-                response.raise_for_status()
-                break # Success
-            except Exception as e:
-                if attempt == max_retries - 1:
-                    print(f"Failed to fetch image after {max_retries} attempts: {e}")
-                    raise HTTPException(status_code=400, detail=f"Error fetching image: {str(e)}")
-                print(f"Image fetch failed (attempt {attempt+1}/{max_retries}). Retrying...")
-                time.sleep(1)
-
-        image = Image.open(BytesIO(response.content)).convert("RGB")
-
-        # Save image temporarily
-        temp_path = "temp_image.png"
-        image.save(temp_path)
-
-        # Get predictions from models
-        result_c = predict_c(image)
-        result_d = predict_d(image)
-
-        if result_c["confidence"] > result_d["confidence"]:
-            result_pred = result_c
-            minor_result = result_d
-        elif result_d["confidence"] > result_c["confidence"]:
-            result_pred = result_d
-            minor_result = result_c
-        else:
-            result_pred = result_c
-            minor_result = result_d
-
-        generation_config = {
-            "temperature": 0.4,
-            "top_p": 1,
-            "top_k": 32,
-            "max_output_tokens": 1024,
-        }
 
-        safety_settings = [
-            {
-                "category": "HARM_CATEGORY_HARASSMENT",
-                "threshold": "BLOCK_NONE"
-            },
-            {
-                "category": "HARM_CATEGORY_HATE_SPEECH",
-                "threshold": "BLOCK_NONE"
-            },
-            {
-                "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-                "threshold": "BLOCK_NONE"
-            },
-            {
-                "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-                "threshold": "BLOCK_NONE"
-            },
-        ]
-
-     
-        # Agent 1: Verify Medical Agent
-        verify_prompt = """Analyze the given skin image as a very good and expert dermatologist to determine if the skin is healthy or unhealthy.
-- Provide a realistic confidence percentage based on visual clarity and distinct presentation of symptoms. Do NOT force it to be 100%.
-- If healthy, classify it as 'Healthy' and provide the confidence level in percentage.
-- If unhealthy, classify it as 'Unhealthy' and provide the confidence level in percentage.
-- Additionally, determine the skin type as one of the following: 'Dry', 'Oily', or 'Normal'.
-- give answer in strictly <classification>,<confidence score in percent>,<skin type>,<remarks : give some remarks that is in one to two lines> format only."""
-        
-        # Open image again for Gemini
-        img = Image.open(temp_path)
-        
-        verify_response = generate_with_retry(
-            prompt=[verify_prompt, img],
-            generation_config=generation_config,
-            safety_settings=safety_settings
+# Pipeline used when a request does not pick one
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "agents")
+SECTIONS = ("verify", "prediction", "report", "jarvis")
+
+SINGLE_SHOT_CONFIG = {
+    **GENERATION_CONFIG,
+    # Room for all four sections at once
+    "max_output_tokens": 4096,
+    "response_mime_type": "application/json",
+    "response_schema": {
+        "type": "object",
+        "properties": {name: {"type": "string"} for name in SECTIONS},
+        "required": list(SECTIONS),
+    },
+}
+
+
+def rank_predictions(result_c, result_d):
+    """Returns (primary, secondary) CNN results ordered by confidence; ties go to predict_c."""
+    if result_d["confidence"] > result_c["confidence"]:
+        return result_d, result_c
+    return result_c, result_d
+
+
+# Agent 1: Verify Medical Agent
+async def run_verify_agent(image_part):
+    verify_response = await generate_with_retry_async(
+        prompt=[VERIFY_PROMPT, image_part],
+        generation_config=GENERATION_CONFIG,
+        safety_settings=SAFETY_SETTINGS
+    )
+    return verify_response.text
+
+
+# Agent 2: Unhealthy Skin Agent
+async def run_prediction_agent(image_part, result_pred, verify_content):
+    unhealthy_prompt = PREDICTION_PROMPT.format(model_prediction=result_pred, verify=verify_content)
+
+    pred_response = await generate_with_retry_async(
+        prompt=[unhealthy_prompt, image_part],
+        generation_config=GENERATION_CONFIG,
+        safety_settings=SAFETY_SETTINGS
+    )
+    return pred_response.text
+
+
+# Agent 3: Report Agent
+async def run_report_agent(image_part, result_pred, minor_result, verify_content, on_chunk=None):
+    # The static instructions go first as a system instruction, the case fields after them
+    report_prompt = REPORT_CASE.format(**case_fields(result_pred, minor_result), verify=verify_content)
+    # For classes in the knowledge pack the LLM only writes the case-specific sections
+    entry = knowledge_pack.entry(result_pred["class"])
+    instructions = REPORT_CASE_INSTRUCTIONS if entry else REPORT_INSTRUCTIONS
+    tail = report_tail(entry) if entry else ""
+
+    if on_chunk is None:
+        report_response = await generate_with_retry_async(
+            prompt=[report_prompt, image_part],
+            generation_config=GENERATION_CONFIG,
+            safety_settings=SAFETY_SETTINGS,
+            hedge="report",
+            system_instruction=instructions
         )
-        verify_content = verify_response.text
+        return report_response.text + tail
+
+    # Streaming mode: hand each chunk to the caller as it arrives and return the full text
+    chunks = []
+    async for text in stream_with_retry_async(
+        prompt=[report_prompt, image_part],
+        generation_config=GENERATION_CONFIG,
+        safety_settings=SAFETY_SETTINGS,
+        system_instruction=instructions
+    ):
+        chunks.append(text)
+        on_chunk(text)
+    if tail:
+        chunks.append(tail)
+        on_chunk(tail)
+    return "".join(chunks)
+
+
+# Agent 4: Jarvis Agent
+async def run_jarvis_agent(result_pred, minor_result, pred_content, report_content):
+    jarvis_prompt = JARVIS_CASE.format(
+        **case_fields(result_pred, minor_result),
+        report=report_content,
+        prediction=pred_content
+    )
 
-        # Agent 2: Unhealthy Skin Agent
-        unhealthy_prompt = f"""Analyze the given skin image as an expert dermatologist. If the skin appears healthy, classify the prediction as 'Healthy' and provide the confidence level. If unhealthy, use the model output to determine the disease. The prediction by deep learning model is {result_pred}. If classified as one of the following: 'Actinic Keratosis', 'Atopic Dermatitis', 'Benign Keratosis', 'Dermatofibroma', 'Melanocytic Nevus', 'Melanoma', 'Squamous Cell Carcinoma', 'Tinea Ringworm Candidiasis', or 'Vascular Lesion', assess the likelihood of skin cancer otherwise its a disease. Provide the disease name, confidence level, and remarks. Additionally, include possible symptoms that might be present for further diagnostic evaluation.
+    jarvis_response = await generate_with_retry_async(
+        prompt=jarvis_prompt,
+        generation_config=GENERATION_CONFIG,
+        safety_settings=SAFETY_SETTINGS,
+        hedge="jarvis",
+        system_instruction=JARVIS_INSTRUCTIONS
+    )
+    return jarvis_response.text
 
-Context from previous analysis: {verify_content}
 
-- give answer in strictly <disease>,<confidence score in percent>,<remarks in two to three lines> format only.
-- If the skin appears healthy, classify it as 'Healthy' and provide the confidence level in percentage."""
+# Single-shot mode: every section from one call
+async def run_single_shot_agent(image_part, result_pred, minor_result):
+    """
+    Asks for verify, prediction, report and jarvis in one structured call.
+    Raises ValueError if the response is not a JSON object with all four sections.
+    """
+    single_prompt = SINGLE_SHOT_PROMPT.format(**case_fields(result_pred, minor_result), model_prediction=result_pred)
 
-        pred_response = generate_with_retry(
-            prompt=[unhealthy_prompt, img],
-            generation_config=generation_config,
-            safety_settings=safety_settings
-        )
-        pred_content = pred_response.text
+    single_response = await generate_with_retry_async(
+        prompt=[single_prompt, image_part],
+        generation_config=SINGLE_SHOT_CONFIG,
+        safety_settings=SAFETY_SETTINGS
+    )
+    sections = json.loads(single_response.text)
+    if not isinstance(sections, dict):
+        raise ValueError("single-shot response is not a JSON object")
+    missing = [name for name in SECTIONS if not isinstance(sections.get(name), str) or not sections[name].strip()]
+    if missing:
+        raise ValueError(f"single-shot response is missing {', '.join(missing)}")
+    return {name: sections[name] for name in SECTIONS}
 
-        # Intermediate save removed to prevent duplicates - we save everything at the end now.
 
+async def resolve_image_url(req: Id):
+    """Returns the requested image URL, falling back to the patient's latest skin image."""
+    # Priority 1: Use specific image URL
+    if req.imageUrl and req.imageUrl.strip():
+        print(f"Using provided image URL: {req.imageUrl}")
+        return req.imageUrl
 
-        # Extract filename from URL for report
-        image_name = image_url.split('/')[-1] if image_url else "Unknown"
+    # Priority 2: Fallback to latest
+    try:
+        # Only skinImages is read, and repeat lookups are served from memory
+        skin_images = await patient_cache.get_skin_images(req.obj_id)
+
+        if skin_images is None:
+            print("Patient document not found")
+            return None
+        if not skin_images:
+            print("No images found in patient record")
+            return None
+
+        image_url = skin_images[-1] # Get the last added image
+        print(f"Found image URL: {image_url}")
+        return image_url
+    except Exception as e:
+        print(f"Error fetching from Firestore: {e}")
+        return None
 
-        # Agent 3: Report Agent
 
-        report_prompt = f"""
-        Act as a senior consultant dermatologist. Generate a highly detailed and comprehensive medical report for the following case.
-        
-        **Patient Analysis Context:**
-        - Suspected Condition: {result_pred['class']} (Confidence: {result_pred['confidence']:.2f})
-        - Secondary Possibility: {minor_result['class']} (Confidence: {minor_result['confidence']:.2f})
-        - Initial Assessment: {verify_content}
-        
-        **Required Report Structure (Use Markdown):**
+def decode_case_image(image_bytes):
+    """
+    Decodes fetched bytes into the RGB image for the CNNs, the compact in-memory JPEG
+    part shared by every Gemini agent, and the SHA-256 of the bytes used to key cached
+    results. Nothing touches the disk, so concurrent requests cannot clobber each other's image.
+    """
+    image = decode_image(image_bytes)
+    return image, encode_for_llm(image), content_hash(image_bytes)
 
-        ### 1. Detailed Clinical Observations
-        - Describe lesion morphology (size, color, texture, borders).
-        - Note anatomical location and distribution patterns.
-        - Mention any visible signs of inflammation, scaling, or ulceration.
 
-        ### 2. Differential Diagnosis & Reasoning
-        - **Primary Diagnosis**: Explain why {result_pred['class']} is the most likely diagnosis based on visual evidence.
-        - **Differentials**: List 2-3 other conditions that share similar features but are less likely, and explain why.
+async def load_case_image(image_url):
+    image_bytes = await fetch_image_bytes(image_url)
+    return await run_cpu_bound(decode_case_image, image_bytes)
 
-        ### 3. Pathophysiology (Brief)
-        - Explain the underlying biological mechanism of the primary condition.
 
-        ### 4. Comprehensive Management Plan
-        - **Pharmacological**: Suggest specific generic classes of topical/oral medications (e.g., "Topical corticosteroids", "Antifungals").
-        - **Lifestyle & Hygiene**: Specific advice on skincare, diet, and triggers.
-        - **Home Care**: Actionable steps for the patient.
+def stage_cache_keys(image_hash):
+    """
+    Cache key per pipeline stage. Each key covers the image, the stage's own model or
+    prompt template, and the keys of the stages it consumes, so changing one prompt
+    invalidates that stage and everything downstream of it but nothing upstream.
+    """
+    llm = (FALLBACK_MODELS, GENERATION_CONFIG)
+    keys = {
+        "cnn_c": make_key("cnn_c", image_hash, model_version("cnn")),
+        "cnn_d": make_key("cnn_d", image_hash, model_version("densenet")),
+        "verify": make_key("verify", image_hash, VERIFY_PROMPT, *llm),
+    }
+    keys["prediction"] = make_key("prediction", image_hash, PREDICTION_PROMPT, keys["cnn_c"], keys["cnn_d"], keys["verify"], *llm)
+    # Report and Jarvis also depend on the knowledge pack they may have been stitched from
+    pack = (REPORT_CASE_INSTRUCTIONS, knowledge_pack.version)
+    keys["report"] = make_key("report", image_hash, REPORT_INSTRUCTIONS, REPORT_CASE, keys["cnn_c"], keys["cnn_d"], keys["verify"], *pack, *llm)
+    keys["jarvis"] = make_key("jarvis", JARVIS_INSTRUCTIONS, JARVIS_CASE, keys["cnn_c"], keys["cnn_d"], keys["prediction"], keys["report"], *pack, *llm)
+    keys["single"] = make_key("single", image_hash, SINGLE_SHOT_PROMPT, keys["cnn_c"], keys["cnn_d"], FALLBACK_MODELS, SINGLE_SHOT_CONFIG)
+    return keys
+
+
+async def run_cnns(image, image_hash, use_cache=True):
+    """Both CNN predictions for one image, served from the result cache when possible."""
+    keys = stage_cache_keys(image_hash)
+    names = ("cnn_c", "cnn_d")
+    if use_cache:
+        hits = [await asyncio.to_thread(result_cache.get, keys[name]) for name in names]
+        if all(hit is not None for hit in hits):
+            print("Cache hit for stage 'cnn'")
+            return dict(zip(names, hits))
+
+    # Both model inputs come from one preprocessing pass
+    inputs = await run_cpu_bound(preprocess_for_models, image)
+    # Awaited on the loop, so requests waiting for their batch do not hold inference threads
+    results = await asyncio.gather(
+        predict_c_async(inputs.cnn),
+        predict_d_async(inputs.densenet)
+    )
+    # Only reached when both predictions finished, i.e. no batcher can still be reading the buffers
+    release_model_inputs(inputs)
 
-        ### 5. Prognosis & Follow-up
-        - Expected course of the condition.
-        - Warning signs that require immediate medical attention.
+    for name, result in zip(names, results):
+        await asyncio.to_thread(result_cache.set, keys[name], result)
+    return dict(zip(names, results))
 
-        **Tone:** Professional, clinical, and empathetic.
-        **Format:** strictly markdown, no preamble.
-        """
 
-        report_response = generate_with_retry(
-            prompt=[report_prompt, img],
-            generation_config=generation_config,
-            safety_settings=safety_settings
-        )
-        report_content = report_response.text
+async def run_single_shot(image_part, image_hash, cnn_results, use_cache=True):
+    """
+    All four sections from one cached, structured Gemini call.
+    Returns None when the response cannot be used.
+    """
+    key = stage_cache_keys(image_hash)["single"]
+    if use_cache:
+        hit = await asyncio.to_thread(result_cache.get, key)
+        if hit is not None:
+            print("Cache hit for stage 'single'")
+            return hit
 
-        # Agent 4: Jarvis Agent
-        jarvis_prompt = f"""You are an AI-powered Dermatology Voice Assistant, designed to provide expert-level support to dermatologists. Your role is to analyze report {report_content} recommend evidence-based treatments, and guide doctors on the next steps using the latest research and drug discoveries.
+    try:
+        sections = await run_single_shot_agent(await shared_image_part(image_part, image_hash), *rank_predictions(cnn_results["cnn_c"], cnn_results["cnn_d"]))
+    except ValueError as e:
+        print(f"Single-shot response unusable ({e}), falling back to the agent pipeline")
+        return None
+    await asyncio.to_thread(result_cache.set, key, sections)
+    return sections
 
-The most likely condition the patient could have is **{result_pred['class']}** with a confidence of {result_pred['confidence']:.2f}.
-Additionally, there is a minor possibility of **{minor_result['class']}** with a confidence of {minor_result['confidence']:.2f}.
 
-**Remarks:**
-- **{result_pred['class']}** (Confidence: {result_pred['confidence']:.2f}) is the primary concern and should be prioritized for diagnosis and treatment.
-- **{minor_result['class']}** (Confidence: {minor_result['confidence']:.2f}) may be a secondary condition or share similar symptoms. Further medical evaluation is recommended to rule it out.
+async def run_diagnosis(image, image_part, image_hash, on_stage_done=None, on_report_chunk=None,
+                        use_cache=True, cnn_results=None, mode=None):
+    """
+    Runs both CNNs and the four agents as a DAG and returns every stage's result.
+    Each stage only waits on the stages whose output it actually uses:
+    the CNNs and the verify agent start together, prediction and report
+    run side by side once those are in, and Jarvis needs both of them.
+    Stage results are read from / written to the result cache unless use_cache is False.
+    Pass `cnn_results` (from run_cnns) when the CNNs already ran elsewhere.
+    The image is uploaded to Gemini once, on the first agent that needs it, and every
+    agent references that upload (see llm_files.py).
+
+    Classes in the knowledge pack take the static report sections and the Jarvis advice
+    from it, so Jarvis makes no LLM call for them (see knowledge_pack.py).
+
+    mode="single" asks for all four sections in one structured call instead, and falls
+    back to the agents if that response cannot be parsed.
+    """
+    keys = stage_cache_keys(image_hash)
+
+    if (mode or PIPELINE_MODE) == "single":
+        if cnn_results is None:
+            cnn_results = await run_cnns(image, image_hash, use_cache)
+        if on_stage_done:
+            on_stage_done("cnn", cnn_results)
+
+        sections = await run_single_shot(image_part, image_hash, cnn_results, use_cache)
+        if sections is not None:
+            if on_stage_done:
+                for name in SECTIONS:
+                    on_stage_done(name, sections[name])
+            return {"cnn": cnn_results, "mode": "single", **sections}
+
+        if on_stage_done:
+            emit_stage = on_stage_done
+
+            def on_stage_done(name, result):
+                # The "cnn" event was already sent before the single-shot attempt
+                if name != "cnn":
+                    emit_stage(name, result)
+
+    def cached(name, fn):
+        async def stage(**inputs):
+            if use_cache:
+                hit = await asyncio.to_thread(result_cache.get, keys[name])
+                if hit is not None:
+                    print(f"Cache hit for stage '{name}'")
+                    return hit
+            result = await fn(**inputs)
+            await asyncio.to_thread(result_cache.set, keys[name], result)
+            return result
+        return stage
+
+    async def cnn():
+        if cnn_results is not None:
+            return cnn_results
+        return await run_cnns(image, image_hash, use_cache)
+
+    async def verify():
+        return await run_verify_agent(await shared_image_part(image_part, image_hash))
+
+    async def prediction(cnn, verify):
+        return await run_prediction_agent(await shared_image_part(image_part, image_hash), rank_predictions(cnn["cnn_c"], cnn["cnn_d"])[0], verify)
+
+    async def report(cnn, verify):
+        return await run_report_agent(await shared_image_part(image_part, image_hash), *rank_predictions(cnn["cnn_c"], cnn["cnn_d"]), verify, on_chunk=on_report_chunk)
+
+    async def jarvis(cnn, prediction, report):
+        result_pred, minor_result = rank_predictions(cnn["cnn_c"], cnn["cnn_d"])
+        entry = knowledge_pack.entry(result_pred["class"])
+        if entry is not None:
+            # Precomputed advice for this class, no LLM call
+            return pack_jarvis(entry, result_pred, minor_result)
+        return await run_jarvis_agent(result_pred, minor_result, prediction, report)
+
+    results = await run_dag({
+        "cnn": ((), cnn),
+        "verify": ((), cached("verify", verify)),
+        "prediction": (("cnn", "verify"), cached("prediction", prediction)),
+        "report": (("cnn", "verify"), cached("report", report)),
+        "jarvis": (("cnn", "prediction", "report"), cached("jarvis", jarvis)),
+    }, on_stage_done=on_stage_done)
+    results["mode"] = "agents"
+    return results
+
+
+def build_response(image_url, results):
+    # Field names are the ones patientController.js reads
+    return {
+        "imageUrl": image_url,
+        "verify": results["verify"],
+        "prediction": results["prediction"],
+        "report": results["report"],
+        "jarvis": results["jarvis"],
+        # Which pipeline produced the sections, so the two modes can be compared
+        "mode": results["mode"],
+        "diagnosisClass": rank_predictions(results["cnn"]["cnn_c"], results["cnn"]["cnn_d"])[0]["class"]
+    }
 
-### 1️⃣ Understand & Analyze the Case
-- Listen to the doctor's query about a patient's condition.
-- Identify the disease or condition being discussed.
-- Analyze symptoms, affected areas, and disease progression based on the given context or medical report.
 
-### 2️⃣ Provide the Latest Treatment Recommendations
-- Fetch current treatment guidelines, FDA-approved drugs, and clinical trials using web sources.
-- Explain the best available treatment options, including topical, oral, biologic, and advanced therapies.
-- Compare traditional treatments with newly discovered therapies (e.g., AI-assisted skin diagnostics, gene therapy, biologics).
+async def save_report(obj_id, response):
+    """
+    Queues the report for the patient's reports subcollection and diagnosis context.
+    Returns once it is in the durable local spool; Firestore is written in the background.
+    """
+    try:
+        await report_writer.enqueue(obj_id, response)
+        # The chat sees the new diagnosis right away, before the write-behind lands
+        context_store.put(obj_id, response)
+    except Exception as e:
+        print(f"Error queueing final report for Firestore: {e}")
 
-### 3️⃣ Generate a Complete Prescription Plan
-- Suggest medications, dosages, frequency, and possible side effects.
-- Recommend adjunct therapies, such as lifestyle modifications and skincare routines.
-- Warn about contraindications or potential drug interactions.
 
-### 4️⃣ Guide the Doctor on the Next Steps
-- Recommend further diagnostic tests (e.g., biopsy, dermoscopy, blood tests, genetic markers).
-- Suggest patient follow-up intervals and monitoring plans.
-- Provide guidelines for managing severe or resistant cases.
+@app.post("/predict")
+async def classify_image(req: Id):
+    image_url = await resolve_image_url(req)
+    if not image_url:
+        raise HTTPException(status_code=404, detail="Image not found")
 
-### 5️⃣ Provide Reliable Medical Sources & Links
-- Fetch research-backed insights from trusted sources such as PubMed, JAMA Dermatology, The Lancet, FDA, and WHO.
-- Offer links to the latest studies, treatment guidelines, and clinical trials for validation.
+    try:
+        image, image_part, image_hash = await load_case_image(image_url)
+        results = await run_diagnosis(image, image_part, image_hash, use_cache=req.use_cache, mode=req.mode)
 
-Context: {pred_content}
+        response = build_response(image_url, results)
+        await save_report(req.obj_id, response)
+        return response
 
-Instructions should be understandable by Dermatologists not for layman audience and make it like a professional advice to doctor like doctor is giving advice to the other doctor and make complete instruction summarize and in 4 to 5 lines pointwise.
-- give answer in proper markdown format."""
+    except httpx.HTTPError as e:
+        raise HTTPException(status_code=400, detail=f"Error fetching image: {str(e)}")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
 
-        jarvis_response = generate_with_retry(
-            prompt=jarvis_prompt,
-            generation_config=generation_config,
-            safety_settings=safety_settings
-        )
-        jarvis_content = jarvis_response.text
 
-        # Clean up temp file
-        if os.path.exists(temp_path):
-            try:
-                os.remove(temp_path)
-            except:
-                pass
+@app.post("/predict/stream")
+async def classify_image_stream(req: Id):
+    """
+    Streaming variant of /predict. Returns newline-delimited JSON events:
+    "started", one event per finished stage ("cnn", "verify", "prediction", "report",
+    "jarvis"), "report_chunk" deltas while the report is being generated,
+    then "done" with the same payload /predict returns, or "error".
+    """
+    image_url = await resolve_image_url(req)
+    if not image_url:
+        raise HTTPException(status_code=404, detail="Image not found")
 
-        # Update the report with final generated content
-        try:
-            # Find the latest report we just added (using a query since we didn't save the ref ID, 
-            # or better yet, we should have saved the ref. But for now, let's just add a new one or update latest)
-            # Actually, let's just do a fire-and-forget update to the latest document we *should* have tracked.
-            # To be safe and simple: let's just write EVERYTHING at the end instead of the middle.
-            
-            final_report_data = {
-                "patientId": obj_id,
-                "timestamp": firestore.SERVER_TIMESTAMP,
-                "imageUrl": image_url,
-                "verify": verify_content,
-                "prediction": pred_content,
-                "report": report_content,
-                "jarvis": jarvis_content
-            }
-            
-            # Save to subcollection
-            db.collection("patients").document(obj_id).collection("reports").add(final_report_data)
-            
-            # Update latest context
-            db.collection("diagnoses").document("latest").set(final_report_data)
+    queue = asyncio.Queue()
+
+    def emit(event, **payload):
+        queue.put_nowait(json.dumps({"event": event, **payload}) + "\n")
+
+    def on_stage_done(name, result):
+        if name == "cnn":
+            emit(name, result=result)
+        else:
+            emit(name, content=result)
 
+    async def pipeline():
+        try:
+            image, image_part, image_hash = await load_case_image(image_url)
+            results = await run_diagnosis(
+                image, image_part, image_hash,
+                on_stage_done=on_stage_done,
+                on_report_chunk=lambda text: emit("report_chunk", delta=text),
+                use_cache=req.use_cache,
+                mode=req.mode
+            )
+            response = build_response(image_url, results)
+            await save_report(req.obj_id, response)
+            emit("done", **response)
+        except httpx.HTTPError as e:
+            emit("error", detail=f"Error fetching image: {str(e)}")
         except Exception as e:
-            print(f"Error saving final report to Firestore: {e}")
-
-        return {
-            "imageUrl": image_url,
-            "verify": verify_content,
-            "prediction": pred_content,
-            "report": report_content,
-            "jarvis": jarvis_content
+            emit("error", detail=f"Error: {str(e)}")
+        finally:
+            queue.put_nowait(None)
+
+    async def events():
+        task = asyncio.create_task(pipeline())
+        try:
+            yield json.dumps({"event": "started", "imageUrl": image_url}) + "\n"
+            while True:
+                line = await queue.get()
+                if line is None:
+                    break
+                yield line
+        finally:
+            # Client went away: stop spending on the remaining agents
+            task.cancel()
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+# Per-stage concurrency for bulk re-screening. The CNN stage is wide so enough images
+# wait on the micro-batcher at once to fill its batches (the wait is awaited on the loop,
+# see predict_c_async, so it does not hold inference threads); the LLM stage is narrow
+# because Gemini quota, not CPU, is the limit there.
+BATCH_FETCH_CONCURRENCY = int(os.getenv("BATCH_FETCH_CONCURRENCY", "16"))
+BATCH_CNN_CONCURRENCY = int(os.getenv("BATCH_CNN_CONCURRENCY", "16"))
+BATCH_LLM_CONCURRENCY = int(os.getenv("BATCH_LLM_CONCURRENCY", "4"))
+
+
+def batch_sizes_since(before):
+    """Micro-batches run per model, and their mean size, since the `before` snapshot of batch_stats()."""
+    sizes = {}
+    for name, now in batch_stats().items():
+        start = before.get(name, {"batches": 0, "images": 0})
+        batches = now["batches"] - start["batches"]
+        images = now["images"] - start["images"]
+        sizes[name] = {"batches": batches, "mean_batch_size": round(images / batches, 2) if batches else 0}
+    return sizes
+
+
+async def run_batch(items):
+    """
+    Re-screens many images through a pipelined resolve -> fetch -> decode -> CNN -> agents
+    engine with bounded concurrency at each stage. Yields one "item" event per image as it
+    completes (in completion order) and a final "summary" event.
+    """
+    async def resolve(item):
+        image_url = await resolve_image_url(item)
+        if not image_url:
+            raise LookupError("Image not found")
+        return {"req": item, "image_url": image_url}
+
+    async def fetch(state):
+        state["image_bytes"] = await fetch_image_bytes(state["image_url"])
+        return state
+
+    async def decode(state):
+        state["image"], state["image_part"], state["image_hash"] = await run_cpu_bound(
+            decode_case_image, state.pop("image_bytes")
+        )
+        return state
+
+    async def cnn(state):
+        state["cnn"] = await run_cnns(state["image"], state["image_hash"], state["req"].use_cache)
+        return state
+
+    async def agents(state):
+        results = await run_diagnosis(
+            state["image"], state["image_part"], state["image_hash"],
+            use_cache=state["req"].use_cache,
+            cnn_results=state["cnn"],
+            mode=state["req"].mode
+        )
+        response = build_response(state["image_url"], results)
+        await save_report(state["req"].obj_id, response)
+        return response
+
+    stages = [
+        Stage("resolve", resolve, BATCH_FETCH_CONCURRENCY),
+        Stage("fetch", fetch, BATCH_FETCH_CONCURRENCY),
+        Stage("decode", decode, INFERENCE_WORKERS),
+        Stage("cnn", cnn, BATCH_CNN_CONCURRENCY),
+        Stage("agents", agents, BATCH_LLM_CONCURRENCY),
+    ]
+
+    start = time.perf_counter()
+    batches_before = batch_stats()
+    succeeded = 0
+    failed_by_stage = {}
+    async for job in run_pipeline(items, stages):
+        item = items[job.index]
+        event = {
+            "event": "item",
+            "index": job.index,
+            "obj_id": item.obj_id,
+            "elapsed": round(job.elapsed, 2),
         }
+        if job.error is None:
+            succeeded += 1
+            event.update(status="ok", result=job.value)
+        else:
+            failed_by_stage[job.failed_stage] = failed_by_stage.get(job.failed_stage, 0) + 1
+            event.update(status="error", stage=job.failed_stage, detail=str(job.error))
+        yield event
+
+    yield {
+        "event": "summary",
+        "total": len(items),
+        "succeeded": succeeded,
+        "failed": len(items) - succeeded,
+        "failed_by_stage": failed_by_stage,
+        "elapsed": round(time.perf_counter() - start, 2),
+        "cnn_batches": batch_sizes_since(batches_before),
+    }
 
-    except requests.exceptions.RequestException as e:
-        raise HTTPException(status_code=400, detail=f"Error fetching image: {str(e)}")
-    except Exception as e:
-        raise HTTPException(status_code=500, detail=f"Error: {str(e)}")
+
+@app.post("/predict/batch")
+async def classify_batch(req: BatchRequest):
+    """Bulk /predict. Streams newline-delimited JSON: one "item" event per image, then a "summary"."""
+    async def events():
+        async for event in run_batch(req.items):
+            yield json.dumps(event) + "\n"
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
+
+async def embed_query(text):
+    result = await asyncio.to_thread(
+        genai.embed_content, model=f"models/{EMBEDDING_MODEL}", content=text, task_type="SEMANTIC_SIMILARITY"
+    )
+    return result["embedding"]
 
 
 @app.post("/ans")
 async def get_ans(q: Query):
+    # Only the patient the doctor is looking at; without one the chat answers without context
+    patient_id = q.obj_id
     try:
-        # Fetch latest diagnosis context from Firestore
-        doc_ref = db.collection("diagnoses").document("latest")
-        doc = doc_ref.get()
-        if doc.exists:
-            mongo_pred = doc.to_dict().get("pred", "")
-        else:
-            mongo_pred = ""
+        # Served from the per-patient context cache; Firestore is only read on a miss
+        diagnosis = await context_store.get(patient_id) if patient_id else None
     except Exception:
-        mongo_pred = ""
+        diagnosis = None
+    context = format_context(diagnosis)
 
-    generation_config = {
-        "temperature": 0.4,
-        "top_p": 1,
-        "top_k": 32,
-        "max_output_tokens": 1024,
-    }
+    # Near-duplicate questions about the same diagnosis are answered from the cache
+    cached, probe = await answer_cache.lookup(q.query, (diagnosis or {}).get("diagnosisClass"), context=context)
+    if cached is not None:
+        return {"response": cached}
 
-    safety_settings = [
-        {
-            "category": "HARM_CATEGORY_HARASSMENT",
-            "threshold": "BLOCK_NONE"
-        },
-        {
-            "category": "HARM_CATEGORY_HATE_SPEECH",
-            "threshold": "BLOCK_NONE"
-        },
-        {
-            "category": "HARM_CATEGORY_SEXUALLY_EXPLICIT",
-            "threshold": "BLOCK_NONE"
-        },
-        {
-            "category": "HARM_CATEGORY_DANGEROUS_CONTENT",
-            "threshold": "BLOCK_NONE"
-        },
-    ]
-
-    ans_prompt = f"""Analyze the given question as an expert dermatologist.
-Diagnosis context: {mongo_pred if mongo_pred else 'No context available'}.
-Question: {q.query}
-- Provide concise answer.
-- Include references."""
+    ans_prompt = ANS_PROMPT.format(
+        context=context if context else 'No context available',
+        query=q.query
+    )
 
     # Use global retry function with fallback support
-    response = generate_with_retry(
+    response = await generate_with_retry_async(
         prompt=ans_prompt,
-        generation_config=generation_config,
-        safety_settings=safety_settings
+        generation_config=GENERATION_CONFIG,
+        safety_settings=SAFETY_SETTINGS
     )
+    answer_cache.store(probe, response.text)
     return {"response": response.text}
 
 
+@app.get("/ans/cache")
+def answer_cache_stats():
+    """Entries per diagnosis class and hit counts of the chat answer cache."""
+    return answer_cache.stats()
+
+
+@app.delete("/ans/cache")
+def invalidate_answer_cache(diagnosis_class: Optional[str] = None):
+    """Drops cached chat answers for one diagnosis class, or all of them."""
+    return {"invalidated": answer_cache.invalidate(diagnosis_class)}
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run('main:app', host="127.0.0.1", port=6700, reload=True)
\ No newline at end of file
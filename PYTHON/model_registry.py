@@ -0,0 +1,160 @@
+import os
+import threading
+
+import torch
+from torchvision import models
+
+from notebooks.model import SkinDiseaseCNN
+
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+
+# Which implementation serves inference: "eager" (the .pth checkpoints), or one of the
+# artifacts written by export_models.py: "torchscript", "quantized" (int8) or "onnx".
+INFERENCE_BACKEND = os.getenv("INFERENCE_BACKEND", "eager")
+EXPORT_DIR = os.getenv("EXPORT_DIR", r"./models/exported")
+BACKENDS = ("eager", "torchscript", "quantized", "onnx")
+
+# int8 kernels and ONNX Runtime serve from the CPU
+if INFERENCE_BACKEND in ("quantized", "onnx"):
+    device = torch.device("cpu")
+else:
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+# Every model the service serves, keyed by the name predict_c / predict_d ask for.
+# input_size is the square resolution the model was trained on (used for warm-up).
+MODEL_SPECS = {
+    "cnn": {
+        "weights": r"./models/skin_disease_model.pth",
+        "num_classes": 9,
+        "input_size": 128,
+    },
+    "densenet": {
+        "weights": r"./models/model_epoch_25.pth",
+        "num_classes": 23,
+        "input_size": 512,
+    },
+}
+
+_models = {}
+_lock = threading.Lock()
+
+
+def build_densenet121(num_classes):
+    """DenseNet-121 backbone with the custom classifier head used in training."""
+    model = models.densenet121(weights=None)
+    num_features = model.classifier.in_features
+    model.classifier = torch.nn.Sequential(
+        torch.nn.Linear(num_features, 512),
+        torch.nn.ReLU(),
+        torch.nn.Dropout(0.4),
+        torch.nn.Linear(512, 256),
+        torch.nn.ReLU(),
+        torch.nn.Dropout(0.3),
+        torch.nn.Linear(256, num_classes)
+    )
+    return model
+
+
+class OnnxModel:
+    """Wraps an ONNX Runtime session so it can be called like the eager module."""
+
+    def __init__(self, path):
+        if ort is None:
+            raise RuntimeError("INFERENCE_BACKEND=onnx requires the onnxruntime package")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def __call__(self, inputs):
+        outputs = self.session.run(None, {self.input_name: inputs.detach().cpu().numpy()})
+        return torch.from_numpy(outputs[0])
+
+
+def exported_path(name, backend):
+    extension = {"torchscript": ".ts.pt", "quantized": ".int8.pt", "onnx": ".onnx"}[backend]
+    return os.path.join(EXPORT_DIR, f"{name}{extension}")
+
+
+def build_eager(name, map_location=None):
+    """The fp32 PyTorch module for `name`, loaded from its training checkpoint."""
+    spec = MODEL_SPECS[name]
+    if name == "cnn":
+        model = SkinDiseaseCNN(num_classes=spec["num_classes"])
+    else:
+        model = build_densenet121(spec["num_classes"])
+    model.load_state_dict(torch.load(spec["weights"], map_location=map_location or device, weights_only=False))
+    model.eval()
+    return model
+
+
+def load_backend(name, backend=INFERENCE_BACKEND):
+    """Loads `name` for the given backend; everything returned is callable on a (N, 3, H, W) tensor."""
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown inference backend '{backend}', expected one of {BACKENDS}")
+
+    if backend == "eager":
+        return build_eager(name).to(device)
+    if backend == "onnx":
+        return OnnxModel(exported_path(name, backend))
+
+    # TorchScript and int8 models are both saved as TorchScript archives
+    map_location = "cpu" if backend == "quantized" else device
+    model = torch.jit.load(exported_path(name, backend), map_location=map_location)
+    model.eval()
+    return model
+
+
+def _weights_path(name):
+    if INFERENCE_BACKEND == "eager":
+        return MODEL_SPECS[name]["weights"]
+    return exported_path(name, INFERENCE_BACKEND)
+
+
+def model_version(name):
+    """
+    Cheap identifier of the weights currently serving `name` (backend, file name, size, mtime).
+    Changes whenever the checkpoint or export is replaced, so cached predictions can be keyed on it.
+    """
+    path = _weights_path(name)
+    try:
+        stat = os.stat(path)
+        return f"{INFERENCE_BACKEND}:{os.path.basename(path)}:{stat.st_size}:{int(stat.st_mtime)}"
+    except OSError:
+        return f"{INFERENCE_BACKEND}:{os.path.basename(path)}"
+
+
+def get_model(name):
+    """
+    Returns the ready-to-use model registered under `name`.
+    Weights are deserialized on first use only; every later call returns the same module.
+    """
+    model = _models.get(name)
+    if model is not None:
+        return model
+
+    with _lock:
+        # Another thread may have finished loading while we waited for the lock
+        if name not in _models:
+            print(f"Loading model '{name}' ({INFERENCE_BACKEND}) from {_weights_path(name)}...")
+            _models[name] = load_backend(name)
+        return _models[name]
+
+
+def warmup():
+    """
+    Loads every registered model and runs one dummy forward pass through each,
+    so the first real request does not pay for weight loading or lazy kernel setup.
+    """
+    for name, spec in MODEL_SPECS.items():
+        model = get_model(name)
+        size = spec["input_size"]
+        dummy = torch.zeros(1, 3, size, size, device=device)
+        with torch.no_grad():
+            model(dummy)
+        print(f"Model '{name}' warmed up")
@@ -0,0 +1,165 @@
+import json
+import os
+import threading
+import time
+
+import google.generativeai as genai
+
+
+# Breaker opens after this many failures in a row, or when the error-rate EWMA passes the threshold
+BREAKER_FAILURES = int(os.getenv("GEMINI_BREAKER_FAILURES", "3"))
+BREAKER_ERROR_RATE = float(os.getenv("GEMINI_BREAKER_ERROR_RATE", "0.5"))
+# First open period; doubles every time a half-open probe fails, up to the max
+BREAKER_OPEN_SECONDS = float(os.getenv("GEMINI_BREAKER_OPEN_SECONDS", "30"))
+BREAKER_MAX_OPEN_SECONDS = float(os.getenv("GEMINI_BREAKER_MAX_OPEN_SECONDS", "600"))
+# Weight of the newest sample in the latency and error-rate moving averages
+HEALTH_ALPHA = float(os.getenv("GEMINI_HEALTH_ALPHA", "0.2"))
+# Relative cost per model, e.g. '{"gemini-2.5-flash": 4, "gemini-2.5-flash-lite": 1}'.
+# Models not listed cost their 1-based position in the preference list.
+MODEL_COSTS = json.loads(os.getenv("GEMINI_MODEL_COSTS", "{}"))
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Latency assumed for a model with no samples yet, so untried models are neither favoured nor starved
+_DEFAULT_LATENCY = 2.0
+
+
+class ModelHealth:
+    def __init__(self):
+        self.state = CLOSED
+        self.latency = None  # EWMA of successful call latency, seconds
+        self.error_rate = 0.0  # EWMA of failures (1) vs successes (0)
+        self.consecutive_failures = 0
+        self.open_seconds = BREAKER_OPEN_SECONDS
+        self.retry_at = 0.0
+        self.probe_in_flight = False
+
+    def snapshot(self):
+        return {
+            "state": self.state,
+            "latency": round(self.latency, 3) if self.latency is not None else None,
+            "error_rate": round(self.error_rate, 3),
+            "consecutive_failures": self.consecutive_failures,
+        }
+
+
+class ModelRouter:
+    """
+    Health-aware routing over the Gemini fallback models.
+
+    Every model has a circuit breaker: closed while healthy, open (skipped) for a cool-off period
+    after repeated failures, then half-open, when a single probe call decides whether it closes
+    again or re-opens for twice as long. Candidates are ordered by breaker state, then by a score
+    of latency EWMA inflated by error rate and multiplied by relative cost. GenerativeModel
+    instances are cached per (model, generation config, safety settings, system instruction).
+    """
+
+    def __init__(self):
+        self._health = {}
+        self._models = {}
+        self._lock = threading.Lock()
+
+    def _get(self, model_name):
+        health = self._health.get(model_name)
+        if health is None:
+            health = self._health[model_name] = ModelHealth()
+        return health
+
+    def model(self, model_name, generation_config, safety_settings, system_instruction=None):
+        key = (
+            model_name,
+            json.dumps(generation_config, sort_keys=True),
+            json.dumps(safety_settings, sort_keys=True),
+            system_instruction,
+        )
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = self._models[key] = genai.GenerativeModel(
+                    model_name=model_name,
+                    generation_config=generation_config,
+                    safety_settings=safety_settings,
+                    system_instruction=system_instruction
+                )
+            return model
+
+    def order(self, candidates):
+        """
+        Healthiest, cheapest models first. Open breakers are left out unless every candidate
+        is open, in which case the one due to recover soonest is tried rather than failing outright.
+        """
+        now = time.time()
+        ranked = []
+        fallback = []
+        with self._lock:
+            for position, model_name in enumerate(candidates):
+                health = self._get(model_name)
+                if health.state == OPEN and now >= health.retry_at:
+                    health.state = HALF_OPEN
+                if health.state == OPEN or (health.state == HALF_OPEN and health.probe_in_flight):
+                    fallback.append((health.retry_at, model_name))
+                    continue
+                latency = health.latency if health.latency is not None else _DEFAULT_LATENCY
+                cost = MODEL_COSTS.get(model_name, position + 1)
+                score = latency * (1 + 4 * health.error_rate) * cost
+                # Closed breakers before half-open ones, so probes only get traffic that has nowhere better to go
+                ranked.append((health.state == HALF_OPEN, score, model_name))
+
+        if ranked:
+            return [model_name for _, _, model_name in sorted(ranked)]
+        return [model_name for _, model_name in sorted(fallback)]
+
+    def on_dispatch(self, model_name):
+        """Marks the probe of a half-open model as taken so concurrent callers route elsewhere."""
+        with self._lock:
+            health = self._get(model_name)
+            if health.state == HALF_OPEN:
+                health.probe_in_flight = True
+
+    def record_success(self, model_name, latency):
+        with self._lock:
+            health = self._get(model_name)
+            health.latency = latency if health.latency is None else (
+                HEALTH_ALPHA * latency + (1 - HEALTH_ALPHA) * health.latency
+            )
+            health.error_rate *= 1 - HEALTH_ALPHA
+            health.consecutive_failures = 0
+            if health.state != CLOSED:
+                print(f"Model router: {model_name} recovered, closing breaker")
+            health.state = CLOSED
+            health.open_seconds = BREAKER_OPEN_SECONDS
+            health.probe_in_flight = False
+
+    def record_failure(self, model_name, error):
+        with self._lock:
+            health = self._get(model_name)
+            health.error_rate = HEALTH_ALPHA + (1 - HEALTH_ALPHA) * health.error_rate
+            health.consecutive_failures += 1
+            if health.state == HALF_OPEN:
+                # Failed probe: back off for longer
+                health.open_seconds = min(health.open_seconds * 2, BREAKER_MAX_OPEN_SECONDS)
+                self._open(model_name, health, error)
+            elif health.state == CLOSED and (
+                health.consecutive_failures >= BREAKER_FAILURES or health.error_rate >= BREAKER_ERROR_RATE
+            ):
+                self._open(model_name, health, error)
+
+    def _open(self, model_name, health, error):
+        health.state = OPEN
+        health.retry_at = time.time() + health.open_seconds
+        health.probe_in_flight = False
+        print(f"Model router: opening breaker for {model_name} for {health.open_seconds:.0f}s ({error})")
+
+    def release_probe(self, model_name):
+        """A half-open probe that ended without a verdict (e.g. cancelled) frees the probe slot."""
+        with self._lock:
+            self._get(model_name).probe_in_flight = False
+
+    def stats(self):
+        with self._lock:
+            return {model_name: health.snapshot() for model_name, health in self._health.items()}
+
+
+router = ModelRouter()
@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+PATIENT_CACHE_TTL = int(os.getenv("PATIENT_CACHE_TTL", "60"))  # seconds
+PATIENT_CACHE_ENTRIES = int(os.getenv("PATIENT_CACHE_ENTRIES", "1024"))
+# Keep cached patients fresh with Firestore listeners instead of expiring them after the TTL
+PATIENT_CACHE_LISTEN = os.getenv("PATIENT_CACHE_LISTEN", "0") == "1"
+
+_MISSING = object()
+
+
+class PatientImageCache:
+    """
+    Cache of each patient's skinImages list for the imageUrl fallback. Misses read only that
+    field (a field-masked get), so the rest of the patient document never crosses the wire.
+
+    With PATIENT_CACHE_LISTEN=1 every cached patient also gets an on_snapshot listener (on the
+    sync client, the async one cannot listen) that updates the entry as soon as a new image
+    is added, and entries no longer expire. Listeners are detached when their entry is evicted.
+    """
+
+    def __init__(self, ttl=PATIENT_CACHE_TTL, max_entries=PATIENT_CACHE_ENTRIES, listen=PATIENT_CACHE_LISTEN):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.listen = listen
+        self.adb = None
+        self.db = None
+        self._entries = OrderedDict()  # patient_id -> (expires_at, skin images or None)
+        self._watches = {}
+        self._lock = threading.Lock()
+
+    def bind(self, adb, db=None):
+        self.adb = adb
+        self.db = db
+
+    def _lookup(self, patient_id):
+        with self._lock:
+            entry = self._entries.get(patient_id)
+            if entry is None or entry[0] <= time.time():
+                return _MISSING
+            self._entries.move_to_end(patient_id)
+            return entry[1]
+
+    def _store(self, patient_id, skin_images):
+        expires_at = float("inf") if patient_id in self._watches else time.time() + self.ttl
+        evicted = []
+        with self._lock:
+            self._entries[patient_id] = (expires_at, skin_images)
+            self._entries.move_to_end(patient_id)
+            while len(self._entries) > self.max_entries:
+                evicted_id, _ = self._entries.popitem(last=False)
+                watch = self._watches.pop(evicted_id, None)
+                if watch is not None:
+                    evicted.append(watch)
+        for watch in evicted:
+            watch.unsubscribe()
+
+    def _watch(self, patient_id):
+        def on_snapshot(docs, changes, read_time):
+            for doc in docs:
+                images = (doc.to_dict() or {}).get("skinImages", []) if doc.exists else None
+                with self._lock:
+                    if patient_id in self._entries:
+                        self._entries[patient_id] = (float("inf"), images)
+
+        with self._lock:
+            if patient_id in self._watches:
+                return
+            self._watches[patient_id] = None  # reserve, so concurrent misses do not attach twice
+        try:
+            watch = self.db.collection("patients").document(patient_id).on_snapshot(on_snapshot)
+        except Exception as e:
+            print(f"Patient cache: could not listen to {patient_id}, using the TTL instead: {e}")
+            with self._lock:
+                self._watches.pop(patient_id, None)
+            return
+        with self._lock:
+            self._watches[patient_id] = watch
+
+    async def get_skin_images(self, patient_id):
+        """The patient's skinImages list, or None if the patient document does not exist."""
+        cached = self._lookup(patient_id)
+        if cached is not _MISSING:
+            return cached
+
+        if self.adb is None:
+            raise RuntimeError("Firestore is not available")
+        doc = await self.adb.collection("patients").document(patient_id).get(field_paths=["skinImages"])
+        skin_images = (doc.to_dict() or {}).get("skinImages", []) if doc.exists else None
+        if self.listen and self.db is not None:
+            self._watch(patient_id)
+        self._store(patient_id, skin_images)
+        return skin_images
+
+    def invalidate(self, patient_id):
+        with self._lock:
+            self._entries.pop(patient_id, None)
+
+    def close(self):
+        with self._lock:
+            watches = [watch for watch in self._watches.values() if watch is not None]
+            self._watches.clear()
+        for watch in watches:
+            watch.unsubscribe()
+
+
+patient_cache = PatientImageCache()
@@ -1,7 +1,9 @@
-from notebooks.model import SkinDiseaseCNN
+import asyncio
+from batching import get_batcher
 import torch
 import torchvision.transforms as transforms
 from PIL import Image
+from typing import Union
 
 
 CLASS_NAMES = [
@@ -16,21 +18,28 @@ CLASS_NAMES = [
     "Vascular lesion"
 ]
 
-device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-model = SkinDiseaseCNN(num_classes=9).to(device)
-model.load_state_dict(torch.load(r"./models/skin_disease_model.pth", map_location=device, weights_only=False))
-model.eval()
-
 transform = transforms.Compose([
     transforms.Resize((128, 128)),
     transforms.ToTensor(),
 ])
 
-def predict_c(image: Image.Image):
-    image = transform(image).unsqueeze(0).to(device)
-    with torch.no_grad():
-        output = model(image)
-        probabilities = torch.softmax(output, dim=1)
-        predicted_class = torch.argmax(probabilities, dim=1).item()
-        confidence = probabilities[0, predicted_class].item()
-    return {"class": CLASS_NAMES[predicted_class], "confidence": confidence}
\ No newline at end of file
+
+def _label(probabilities):
+    predicted_class = torch.argmax(probabilities).item()
+    confidence = probabilities[predicted_class].item()
+    return {"class": CLASS_NAMES[predicted_class], "confidence": confidence}
+
+
+def predict_c(image: Union[Image.Image, torch.Tensor]):
+    # Accepts a PIL image or a tensor already produced by imaging.preprocess_for_models
+    tensor = image if isinstance(image, torch.Tensor) else transform(image)
+    # Batch-of-one tensors are merged with concurrent requests by the batcher
+    return _label(get_batcher("cnn").submit(tensor).result())
+
+
+async def predict_c_async(tensor: torch.Tensor):
+    """
+    predict_c for the event loop, on a tensor from imaging.preprocess_for_models. Waiting for the
+    batch does not hold a thread, so every concurrent request can join the same batch.
+    """
+    return _label(await asyncio.wrap_future(get_batcher("cnn").submit(tensor)))
@@ -1,31 +1,13 @@
+import asyncio
 import torch
-from torchvision import models, transforms
+from torchvision import transforms
 from PIL import Image
-from io import BytesIO
-
-
-
-
-def load_model(weights_path, num_classes):
-    model = models.densenet121(weights=None)
-    num_features = model.classifier.in_features
-    model.classifier = torch.nn.Sequential(
-        torch.nn.Linear(num_features, 512),
-        torch.nn.ReLU(),
-        torch.nn.Dropout(0.4),
-        torch.nn.Linear(512, 256),
-        torch.nn.ReLU(),
-        torch.nn.Dropout(0.3),
-        torch.nn.Linear(256, num_classes)
-    )
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model.load_state_dict(torch.load(weights_path, map_location=device, weights_only=False))
-    model.to(device)
-    model.eval()
-    return model
-
-def predict_d(image: Image.Image):
-    class_names = [
+from typing import Union
+
+from batching import get_batcher
+
+
+CLASS_NAMES = [
     "Acne and Rosacea Photos", "Actinic Keratosis Basal Cell Carcinoma and other Malignant Lesions",
     "Atopic Dermatitis Photos", "Bullous Disease Photos", "Cellulitis Impetigo and other Bacterial Infections",
     "Eczema Photos", "Exanthems and Drug Eruptions", "Hair Loss Photos Alopecia and other Hair Diseases",
@@ -35,19 +17,31 @@ def predict_d(image: Image.Image):
     "Psoriasis pictures Lichen Planus and related diseases", "Scabies Lyme Disease and other Infestations and Bites",
     "Seborrheic Keratoses and other Benign Tumors", "Systemic Disease", "Tinea Ringworm Candidiasis and other Fungal Infections",
     "Urticaria Hives", "Vascular Tumors", "Vasculitis Photos", "Warts Molluscum and other Viral Infections"
-    ]
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model = load_model(r"./models/model_epoch_25.pth", num_classes=23)
-    transform = transforms.Compose([
-        transforms.Resize((512, 512)),
-        transforms.ToTensor(),
-        transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
-    ])
-    image = transform(image).unsqueeze(0).to(device)
-    with torch.no_grad():
-        output = model(image)
-        probabilities = torch.softmax(output, dim=1)
-        predicted_class = torch.argmax(probabilities, dim=1).item()
-        confidence = probabilities[0, predicted_class].item()
-    return {"class": class_names[predicted_class], "confidence": confidence}
+]
+
+transform = transforms.Compose([
+    transforms.Resize((512, 512)),
+    transforms.ToTensor(),
+    transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+])
+
+
+def _label(probabilities):
+    predicted_class = torch.argmax(probabilities).item()
+    confidence = probabilities[predicted_class].item()
+    return {"class": CLASS_NAMES[predicted_class], "confidence": confidence}
+
+
+def predict_d(image: Union[Image.Image, torch.Tensor]):
+    # Accepts a PIL image or a tensor already produced by imaging.preprocess_for_models
+    tensor = image if isinstance(image, torch.Tensor) else transform(image)
+    # Batch-of-one tensors are merged with concurrent requests by the batcher
+    return _label(get_batcher("densenet").submit(tensor).result())
+
 
+async def predict_d_async(tensor: torch.Tensor):
+    """
+    predict_d for the event loop, on a tensor from imaging.preprocess_for_models. Waiting for the
+    batch does not hold a thread, so every concurrent request can join the same batch.
+    """
+    return _label(await asyncio.wrap_future(get_batcher("densenet").submit(tensor)))
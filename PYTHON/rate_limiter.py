@@ -0,0 +1,284 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import NamedTuple
+
+
+# Per-model quotas. Defaults match the Gemini free tier for flash-lite; override globally
+# with GEMINI_RPM / GEMINI_TPM or per model with GEMINI_LIMITS='{"model": {"rpm": 30, "tpm": 1000000}}'
+GEMINI_RPM = int(os.getenv("GEMINI_RPM", "15"))
+GEMINI_TPM = int(os.getenv("GEMINI_TPM", "250000"))
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "8"))
+GEMINI_LIMITS = json.loads(os.getenv("GEMINI_LIMITS", "{}"))
+# Set to a file path to share the RPM/TPM buckets between worker processes on this host
+GEMINI_LIMITER_DB = os.getenv("GEMINI_LIMITER_DB")
+# How long a model is skipped after it returned 429 despite the limiter
+GEMINI_COOLDOWN_SECONDS = float(os.getenv("GEMINI_COOLDOWN_SECONDS", "30"))
+
+# Gemini bills one image tile as 258 tokens; text is roughly 4 characters per token
+IMAGE_TOKENS = 258
+CHARS_PER_TOKEN = 4
+# Re-check interval for a caller waiting only on a concurrency slot
+_POLL_INTERVAL = 0.05
+
+
+def estimate_tokens(prompt, generation_config=None, system_instruction=None):
+    """Rough upper bound of the tokens a call will be billed for: input plus max output."""
+    parts = prompt if isinstance(prompt, (list, tuple)) else [prompt]
+    if system_instruction:
+        parts = [system_instruction, *parts]
+    tokens = 0
+    for part in parts:
+        if isinstance(part, str):
+            tokens += len(part) // CHARS_PER_TOKEN + 1
+        else:
+            tokens += IMAGE_TOKENS
+    return tokens + (generation_config or {}).get("max_output_tokens", 1024)
+
+
+def used_tokens(response):
+    """Actual billed tokens from a response, or None when the SDK did not report usage."""
+    usage = getattr(response, "usage_metadata", None)
+    total = getattr(usage, "total_token_count", None)
+    return total or None
+
+
+class Limits(NamedTuple):
+    rpm: int
+    tpm: int
+    concurrency: int
+
+
+class Lease(NamedTuple):
+    model: str
+    tokens: int
+
+
+def _limits_for(model_name):
+    override = GEMINI_LIMITS.get(model_name, {})
+    return Limits(
+        rpm=int(override.get("rpm", GEMINI_RPM)),
+        tpm=int(override.get("tpm", GEMINI_TPM)),
+        concurrency=int(override.get("concurrency", GEMINI_MAX_CONCURRENCY)),
+    )
+
+
+def _refill(level, updated, capacity, now):
+    # Buckets refill continuously at capacity-per-minute
+    return min(capacity, level + (now - updated) * capacity / 60.0)
+
+
+def _wait_for(level, needed, capacity):
+    if needed > capacity:
+        # A single call bigger than the whole minute budget can only ever run on a full bucket
+        needed = capacity
+    return max(0.0, (needed - level) * 60.0 / capacity)
+
+
+class _MemoryBuckets:
+    """RPM and TPM token buckets for this process only."""
+
+    def __init__(self):
+        self._state = {}  # (model, kind) -> (level, updated)
+        self._lock = threading.Lock()
+
+    def take(self, model_name, limits, tokens, now):
+        """Takes one request and `tokens` from the model's buckets, or returns how long until it could."""
+        with self._lock:
+            costs = (("rpm", 1, limits.rpm), ("tpm", tokens, limits.tpm))
+            levels = {}
+            wait = 0.0
+            for kind, cost, capacity in costs:
+                level, updated = self._state.get((model_name, kind), (capacity, now))
+                levels[kind] = _refill(level, updated, capacity, now)
+                wait = max(wait, _wait_for(levels[kind], cost, capacity))
+            if wait > 0:
+                return wait
+            for kind, cost, capacity in costs:
+                self._state[(model_name, kind)] = (levels[kind] - cost, now)
+            return 0.0
+
+    def adjust(self, model_name, limits, delta, now):
+        """Credits (positive) or debits (negative) the TPM bucket once real usage is known."""
+        with self._lock:
+            level, updated = self._state.get((model_name, "tpm"), (limits.tpm, now))
+            level = _refill(level, updated, limits.tpm, now)
+            self._state[(model_name, "tpm")] = (min(limits.tpm, level + delta), now)
+
+
+class _SqliteBuckets:
+    """
+    The same buckets kept in a local SQLite file, so every uvicorn worker (and the rescreen CLI)
+    on the host draws from one quota. Each take is a single IMMEDIATE transaction.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS buckets ("
+                "model TEXT, kind TEXT, level REAL, updated REAL, PRIMARY KEY (model, kind))"
+            )
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn = conn
+        return conn
+
+    def _read(self, conn, model_name, kind, capacity, now):
+        row = conn.execute(
+            "SELECT level, updated FROM buckets WHERE model = ? AND kind = ?", (model_name, kind)
+        ).fetchone()
+        level, updated = row if row else (capacity, now)
+        return _refill(level, updated, capacity, now)
+
+    def _write(self, conn, model_name, kind, level, now):
+        conn.execute(
+            "INSERT OR REPLACE INTO buckets (model, kind, level, updated) VALUES (?, ?, ?, ?)",
+            (model_name, kind, level, now),
+        )
+
+    def take(self, model_name, limits, tokens, now):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rpm = self._read(conn, model_name, "rpm", limits.rpm, now)
+            tpm = self._read(conn, model_name, "tpm", limits.tpm, now)
+            wait = max(_wait_for(rpm, 1, limits.rpm), _wait_for(tpm, tokens, limits.tpm))
+            if wait == 0:
+                self._write(conn, model_name, "rpm", rpm - 1, now)
+                self._write(conn, model_name, "tpm", tpm - tokens, now)
+            conn.execute("COMMIT")
+            return wait
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def adjust(self, model_name, limits, delta, now):
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            tpm = self._read(conn, model_name, "tpm", limits.tpm, now)
+            self._write(conn, model_name, "tpm", min(limits.tpm, tpm + delta), now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+
+class GeminiRateLimiter:
+    """
+    Requests-per-minute and tokens-per-minute token buckets plus an in-flight cap for every
+    Gemini model. Callers queue in FIFO order; the head of the queue is given the first model
+    (in preference order) that has headroom right now, so traffic spills over to a fallback
+    model before the preferred one starts returning 429s.
+    """
+
+    def __init__(self, db_path=GEMINI_LIMITER_DB):
+        self._buckets = _SqliteBuckets(db_path) if db_path else _MemoryBuckets()
+        # SQLite takes can wait up to the busy timeout on another worker's lock; keep them off the loop
+        self._blocking = db_path is not None
+        self._in_flight = {}
+        self._cooldown_until = {}
+        self._lock = threading.Lock()
+        self._queue = None  # asyncio.Lock, created on first use inside the event loop
+        self._sync_queue = threading.Lock()
+
+    def _try_reserve(self, candidates, tokens):
+        """Returns (lease, 0) when a model has headroom, otherwise (None, seconds to wait)."""
+        now = time.time()
+        shortest = None
+        for model_name in candidates:
+            limits = _limits_for(model_name)
+            with self._lock:
+                cooldown = self._cooldown_until.get(model_name, 0) - now
+                busy = self._in_flight.get(model_name, 0) >= limits.concurrency
+            if cooldown > 0:
+                wait = cooldown
+            elif busy:
+                wait = _POLL_INTERVAL
+            else:
+                wait = self._buckets.take(model_name, limits, tokens, now)
+                if wait == 0:
+                    with self._lock:
+                        self._in_flight[model_name] = self._in_flight.get(model_name, 0) + 1
+                    return Lease(model_name, tokens), 0.0
+            shortest = wait if shortest is None else min(shortest, wait)
+        return None, shortest
+
+    async def _try_reserve_async(self, candidates, tokens):
+        if not self._blocking:
+            return self._try_reserve(candidates, tokens)
+        reserve = asyncio.ensure_future(asyncio.to_thread(self._try_reserve, candidates, tokens))
+        try:
+            return await asyncio.shield(reserve)
+        except asyncio.CancelledError:
+            # The thread may still win a slot nobody will use; hand it straight back
+            reserve.add_done_callback(self._release_abandoned)
+            raise
+
+    def _release_abandoned(self, reserve):
+        if not reserve.cancelled() and reserve.exception() is None:
+            lease, _ = reserve.result()
+            if lease is not None:
+                self.release(lease)
+
+    async def acquire(self, candidates, tokens):
+        """Waits (without blocking the loop) for a slot on one of `candidates` and returns its Lease."""
+        if self._queue is None:
+            self._queue = asyncio.Lock()
+        # asyncio.Lock wakes waiters in arrival order, so callers are served first come first served
+        async with self._queue:
+            while True:
+                lease, wait = await self._try_reserve_async(candidates, tokens)
+                if lease is not None:
+                    return lease
+                await asyncio.sleep(min(wait, 1.0))
+
+    def acquire_sync(self, candidates, tokens):
+        """Blocking acquire for code running in worker threads."""
+        with self._sync_queue:
+            while True:
+                lease, wait = self._try_reserve(candidates, tokens)
+                if lease is not None:
+                    return lease
+                time.sleep(min(wait, 1.0))
+
+    def release(self, lease, actual_tokens=None):
+        """Frees the concurrency slot and settles the token estimate against real usage."""
+        with self._lock:
+            self._in_flight[lease.model] -= 1
+        if actual_tokens is None or actual_tokens == lease.tokens:
+            return
+        args = (lease.model, _limits_for(lease.model), lease.tokens - actual_tokens, time.time())
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if self._blocking and loop is not None:
+            # Called from the event loop: settle in a worker thread instead of waiting on the file lock
+            loop.run_in_executor(None, self._adjust, *args)
+        else:
+            self._adjust(*args)
+
+    def _adjust(self, model_name, limits, delta, now):
+        try:
+            self._buckets.adjust(model_name, limits, delta, now)
+        except Exception as e:
+            print(f"Rate limiter: could not settle token usage for {model_name}: {e}")
+
+    def cooldown(self, model_name, seconds=GEMINI_COOLDOWN_SECONDS):
+        """Takes a model out of rotation after a 429 the buckets did not predict."""
+        with self._lock:
+            self._cooldown_until[model_name] = time.time() + seconds
+        print(f"Rate limiter: cooling down {model_name} for {seconds:.0f}s")
+
+
+limiter = GeminiRateLimiter()
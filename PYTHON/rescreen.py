@@ -0,0 +1,84 @@
+"""
+Bulk re-screening from the command line, using the same pipelined engine as /predict/batch.
+
+    python rescreen.py                      # latest image of every patient
+    python rescreen.py --all-images         # every skinImages entry
+    python rescreen.py --patient abc123 --patient def456 --no-cache
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from main import Id, db, run_batch, release_resources, start_report_writer
+from model_registry import warmup
+from knowledge_pack import knowledge_pack
+
+
+def collect_items(patient_ids, all_images, use_cache):
+    """One batch item per image to re-screen, read from the patients collection."""
+    if db is None:
+        raise SystemExit("Firestore is not available, nothing to re-screen")
+    if patient_ids:
+        docs = [db.collection("patients").document(patient_id).get() for patient_id in patient_ids]
+    else:
+        docs = db.collection("patients").select(["skinImages"]).stream()
+
+    items = []
+    for doc in docs:
+        if not doc.exists:
+            print(f"Patient {doc.id} not found, skipped")
+            continue
+        skin_images = (doc.to_dict() or {}).get("skinImages", [])
+        urls = skin_images if all_images else skin_images[-1:]
+        items.extend(Id(obj_id=doc.id, imageUrl=url, use_cache=use_cache) for url in urls)
+    return items
+
+
+async def rescreen(items, output):
+    await start_report_writer()
+    try:
+        async for event in run_batch(items):
+            if output:
+                output.write(json.dumps(event) + "\n")
+            if event["event"] == "item":
+                status = "ok" if event["status"] == "ok" else f"failed at {event['stage']}: {event['detail']}"
+                print(f"[{event['index'] + 1}/{len(items)}] {event['obj_id']} {status} ({event['elapsed']}s)")
+            else:
+                print(
+                    f"Done: {event['succeeded']}/{event['total']} succeeded in {event['elapsed']}s, "
+                    f"failures by stage: {event['failed_by_stage'] or 'none'}, "
+                    f"CNN batches: {event['cnn_batches']}"
+                )
+                return event
+    finally:
+        await release_resources()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-screen stored skin images through the diagnosis pipeline")
+    parser.add_argument("--patient", action="append", default=[], help="only this patient id (repeatable)")
+    parser.add_argument("--all-images", action="store_true", help="every image instead of each patient's latest")
+    parser.add_argument("--no-cache", action="store_true", help="ignore cached stage results")
+    parser.add_argument("--output", help="also write the NDJSON events to this file")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    items = collect_items(args.patient, args.all_images, use_cache=not args.no_cache)
+    print(f"Collected {len(items)} images in {time.perf_counter() - start:.2f}s")
+    if not items:
+        return
+
+    warmup()
+    knowledge_pack.load()
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output:
+            summary = asyncio.run(rescreen(items, output))
+    else:
+        summary = asyncio.run(rescreen(items, None))
+    if summary["failed"]:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
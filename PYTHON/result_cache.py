@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+
+RESULT_CACHE_DIR = os.getenv("RESULT_CACHE_DIR", os.path.join(".cache", "results"))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))  # seconds
+RESULT_CACHE_MAX_MB = int(os.getenv("RESULT_CACHE_MAX_MB", "512"))
+RESULT_CACHE_MEMORY_ENTRIES = int(os.getenv("RESULT_CACHE_MEMORY_ENTRIES", "1024"))
+
+
+def content_hash(data: bytes):
+    return hashlib.sha256(data).hexdigest()
+
+
+def make_key(*parts):
+    """Stable key from any JSON-serializable parts (strings, dicts, other keys)."""
+    payload = json.dumps(parts, sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class TieredCache:
+    """
+    Two-tier cache for JSON-serializable pipeline results.
+    Tier 1 is an in-process LRU; tier 2 is one JSON file per key on local disk,
+    expired after `ttl` seconds and trimmed oldest-first once it grows past `max_bytes`.
+    Disk hits are promoted back into memory.
+    """
+
+    def __init__(self, cache_dir=RESULT_CACHE_DIR, ttl=RESULT_CACHE_TTL,
+                 max_bytes=RESULT_CACHE_MAX_MB * 1024 * 1024, memory_entries=RESULT_CACHE_MEMORY_ENTRIES):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()  # key -> (expires_at, value)
+        self._lock = threading.Lock()
+        self._disk_bytes = None  # computed lazily on first write
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def _remember(self, key, expires_at, value):
+        with self._lock:
+            self._memory[key] = (expires_at, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                if entry[0] > now:
+                    self._memory.move_to_end(key)
+                    return entry[1]
+                del self._memory[key]
+
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if record["expires_at"] <= now:
+            self._remove_file(path)
+            return None
+
+        self._remember(key, record["expires_at"], record["value"])
+        return record["value"]
+
+    def set(self, key, value):
+        expires_at = time.time() + self.ttl
+        self._remember(key, expires_at, value)
+
+        path = self._path(key)
+        data = json.dumps({"expires_at": expires_at, "value": value}).encode("utf-8")
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so a concurrent reader never sees a half-written file
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"Result cache write failed for {key}: {e}")
+            return
+
+        with self._lock:
+            if self._disk_bytes is None:
+                self._disk_bytes = self._scan_size()
+            else:
+                self._disk_bytes += len(data)
+            over_budget = self._disk_bytes > self.max_bytes
+        if over_budget:
+            self._evict()
+
+    def _entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".json"):
+                    path = os.path.join(root, name)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    yield path, stat
+
+    def _scan_size(self):
+        return sum(stat.st_size for _, stat in self._entries())
+
+    def _remove_file(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _evict(self):
+        """Drops expired files, then the least recently written ones until under 90% of the budget."""
+        now = time.time()
+        entries = sorted(self._entries(), key=lambda entry: entry[1].st_mtime)
+        total = sum(stat.st_size for _, stat in entries)
+        target = self.max_bytes * 0.9
+        for path, stat in entries:
+            if total <= target and stat.st_mtime + self.ttl > now:
+                continue
+            self._remove_file(path)
+            total -= stat.st_size
+        with self._lock:
+            self._disk_bytes = total
+        print(f"Result cache trimmed to {total / (1024 * 1024):.1f} MB")
+
+
+result_cache = TieredCache()
@@ -0,0 +1,186 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from result_cache import content_hash
+
+
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "1") == "1"
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-004")
+# Cosine similarity above which an earlier question counts as the same question
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.93"))
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL", str(24 * 3600)))  # seconds
+SEMANTIC_CACHE_ENTRIES = int(os.getenv("SEMANTIC_CACHE_ENTRIES", "500"))  # per scope
+# Scopes (class, variant, patient context) kept, least recently used dropped first
+SEMANTIC_CACHE_SCOPES = int(os.getenv("SEMANTIC_CACHE_SCOPES", "4096"))
+
+NO_CLASS = "none"
+
+
+def normalize_query(query):
+    return " ".join(query.lower().split())
+
+
+class Probe(NamedTuple):
+    """What a lookup learned about a question, so a miss can be stored without embedding it again."""
+    scope: tuple
+    text: str
+    vector: Optional[np.ndarray]
+
+
+class _Shelf:
+    """Cached answers of one scope: unit vectors stacked into one matrix for brute-force search."""
+
+    def __init__(self):
+        self.vectors = None  # (n, dim) float32
+        self.texts = []
+        self.answers = []
+        self.expires = []
+
+    def search(self, vector, now):
+        if self.vectors is None:
+            return None, 0.0
+        scores = self.vectors @ vector
+        for index in np.argsort(scores)[::-1]:
+            if self.expires[index] > now:
+                return index, float(scores[index])
+        return None, 0.0
+
+    def exact(self, text, now):
+        for index in range(len(self.texts) - 1, -1, -1):
+            if self.texts[index] == text and self.expires[index] > now:
+                return index
+        return None
+
+    def add(self, text, vector, answer, expires_at, max_entries):
+        # Expired entries go first, then the oldest ones beyond max_entries
+        now = time.time()
+        keep = [i for i, expires in enumerate(self.expires) if expires > now]
+        keep = keep[max(0, len(keep) - max_entries + 1):]
+        self.vectors = np.vstack([self.vectors[keep], vector[None, :]]) if keep else vector[None, :]
+        self.texts = [self.texts[i] for i in keep] + [text]
+        self.answers = [self.answers[i] for i in keep] + [answer]
+        self.expires = [self.expires[i] for i in keep] + [expires_at]
+
+
+class SemanticAnswerCache:
+    """
+    Answers to chat questions, looked up by meaning rather than exact text. Each question is
+    embedded together with the patient's diagnosis class and compared (cosine, NumPy brute
+    force) with earlier questions in the same scope; the closest one above the threshold
+    returns its stored answer. A repeat of the exact same question skips the embedding call.
+
+    The scope also holds a hash of the diagnosis context the answer was generated from, since
+    the prompt carries that patient's prediction, report and Jarvis text: an answer is only
+    reused for the same diagnosis, never for another patient with the same class. Questions
+    asked without patient context share one scope per class (NO_CLASS) and variant.
+
+    Entries expire after SEMANTIC_CACHE_TTL and every class can be dropped on its own, e.g.
+    when its treatment guidance changes. `embed` (bound by the app) is an async
+    text -> vector function.
+    """
+
+    def __init__(self, threshold=SEMANTIC_CACHE_THRESHOLD, ttl=SEMANTIC_CACHE_TTL,
+                 max_entries=SEMANTIC_CACHE_ENTRIES, max_scopes=SEMANTIC_CACHE_SCOPES, enabled=SEMANTIC_CACHE):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_scopes = max_scopes
+        self.enabled = enabled
+        self._embed = None
+        self._shelves = OrderedDict()  # (diagnosis class, variant, context hash) -> _Shelf
+        self._lock = threading.Lock()
+        self._hits = {"exact": 0, "semantic": 0}
+        self._misses = 0
+
+    def bind(self, embed):
+        self._embed = embed
+
+    @staticmethod
+    def _scope(diagnosis_class, variant, context):
+        context_key = content_hash(context.encode("utf-8")) if context else ""
+        return (normalize_query(diagnosis_class or NO_CLASS), variant, context_key)
+
+    def _shelf(self, scope):
+        shelf = self._shelves.get(scope)
+        if shelf is not None:
+            self._shelves.move_to_end(scope)
+        return shelf
+
+    async def lookup(self, query, diagnosis_class=None, variant="", context=None):
+        """
+        Returns (cached answer or None, probe for store()). `context` is the exact patient
+        context text the prompt will carry, or None when there is none.
+        """
+        scope = self._scope(diagnosis_class, variant, context)
+        text = normalize_query(query)
+        if not self.enabled or self._embed is None:
+            return None, Probe(scope, text, None)
+
+        now = time.time()
+        with self._lock:
+            shelf = self._shelf(scope)
+            index = shelf.exact(text, now) if shelf else None
+            if index is not None:
+                self._hits["exact"] += 1
+                return shelf.answers[index], Probe(scope, text, None)
+
+        try:
+            vector = np.asarray(await self._embed(f"Diagnosis: {scope[0]}\nQuestion: {text}"), dtype=np.float32)
+            vector /= np.linalg.norm(vector) or 1.0
+        except Exception as e:
+            print(f"Semantic cache: embedding failed, answering without the cache: {e}")
+            return None, Probe(scope, text, None)
+
+        with self._lock:
+            shelf = self._shelf(scope)
+            index, score = shelf.search(vector, time.time()) if shelf else (None, 0.0)
+            if index is not None and score >= self.threshold:
+                self._hits["semantic"] += 1
+                print(f"Semantic cache hit ({score:.3f}) for '{text}' ~ '{shelf.texts[index]}'")
+                return shelf.answers[index], Probe(scope, text, vector)
+            self._misses += 1
+        return None, Probe(scope, text, vector)
+
+    def store(self, probe, answer):
+        if probe.vector is None or not answer:
+            return
+        with self._lock:
+            shelf = self._shelf(probe.scope)
+            if shelf is None:
+                shelf = self._shelves[probe.scope] = _Shelf()
+                while len(self._shelves) > self.max_scopes:
+                    self._shelves.popitem(last=False)
+            shelf.add(probe.text, probe.vector, answer, time.time() + self.ttl, self.max_entries)
+
+    def invalidate(self, diagnosis_class=None):
+        """Drops the cached answers of one diagnosis class, or of every class. Returns how many."""
+        with self._lock:
+            if diagnosis_class is None:
+                scopes = list(self._shelves)
+            else:
+                name = normalize_query(diagnosis_class)
+                scopes = [scope for scope in self._shelves if scope[0] == name]
+            return sum(len(self._shelves.pop(scope).answers) for scope in scopes)
+
+    def stats(self):
+        with self._lock:
+            entries = {}
+            for (cls, variant, _), shelf in self._shelves.items():
+                name = f"{cls}/{variant}" if variant else cls
+                entries[name] = entries.get(name, 0) + len(shelf.answers)
+            return {
+                "enabled": self.enabled,
+                "scopes": len(self._shelves),
+                "entries": entries,
+                "hits": dict(self._hits),
+                "misses": self._misses,
+                "threshold": self.threshold,
+            }
+
+
+answer_cache = SemanticAnswerCache()
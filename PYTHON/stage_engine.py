@@ -0,0 +1,74 @@
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, NamedTuple, Optional
+
+
+class Stage(NamedTuple):
+    name: str
+    fn: Callable[[Any], Awaitable[Any]]
+    concurrency: int
+
+
+class Job(NamedTuple):
+    index: int
+    value: Any
+    error: Optional[BaseException] = None
+    failed_stage: Optional[str] = None
+    elapsed: float = 0.0
+
+
+async def run_pipeline(items, stages, queue_factor=2):
+    """
+    Streams `items` through `stages` like an assembly line and yields a Job per item,
+    in completion order.
+
+    Every stage has `concurrency` workers, and stages are joined by bounded queues
+    (queue_factor x concurrency), so a fast stage can only run a little ahead of a slow
+    one and memory stays bounded no matter how many items are fed in. Each stage's
+    `fn` takes the value the previous stage returned. An item whose stage raises is
+    passed straight through to the output with `error` and `failed_stage` set.
+    """
+    queues = [asyncio.Queue(maxsize=max(1, stage.concurrency * queue_factor)) for stage in stages]
+    queues.append(asyncio.Queue())
+    started = {}
+
+    async def feed():
+        for index, item in enumerate(items):
+            started[index] = time.perf_counter()
+            await queues[0].put(Job(index, item))
+        for _ in range(stages[0].concurrency):
+            await queues[0].put(None)
+
+    async def work(position):
+        stage = stages[position]
+        while True:
+            job = await queues[position].get()
+            if job is None:
+                return
+            if job.error is None:
+                try:
+                    job = job._replace(value=await stage.fn(job.value))
+                except Exception as e:
+                    job = job._replace(error=e, failed_stage=stage.name)
+            await queues[position + 1].put(job)
+
+    async def run_stage(position):
+        await asyncio.gather(*(work(position) for _ in range(stages[position].concurrency)))
+        # This stage is drained: tell every worker of the next one to stop
+        following = stages[position + 1].concurrency if position + 1 < len(stages) else 1
+        for _ in range(following):
+            await queues[position + 1].put(None)
+
+    tasks = [asyncio.create_task(feed())]
+    tasks += [asyncio.create_task(run_stage(position)) for position in range(len(stages))]
+
+    try:
+        while True:
+            job = await queues[-1].get()
+            if job is None:
+                break
+            yield job._replace(elapsed=time.perf_counter() - started[job.index])
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,258 @@
+import asyncio
+import datetime
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+from context_store import CONTEXT_COLLECTION, CONTEXT_FIELDS
+
+
+WRITE_BEHIND_SPOOL = os.getenv("WRITE_BEHIND_SPOOL", os.path.join(".cache", "write_behind.sqlite3"))
+# Reports per Firestore WriteBatch; each is at most two writes, report plus patient context (limit 500)
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "200"))
+# How long the writer waits for more reports to coalesce into one batch
+WRITE_BEHIND_LINGER = float(os.getenv("WRITE_BEHIND_LINGER", "0.2"))
+# A claimed row is retried by any worker if its claimant has not finished within this many seconds
+WRITE_BEHIND_CLAIM_SECONDS = int(os.getenv("WRITE_BEHIND_CLAIM_SECONDS", "60"))
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", "20"))
+WRITE_BEHIND_MAX_BACKOFF = int(os.getenv("WRITE_BEHIND_MAX_BACKOFF", "300"))
+
+
+class _Spool:
+    """
+    Durable queue of pending reports in a local SQLite file. Rows are claimed with a lease
+    before being written, so several uvicorn workers can share one spool and a row whose
+    worker died is picked up again once its claim runs out.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._connect()
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS pending ("
+            "report_id TEXT PRIMARY KEY, obj_id TEXT, payload TEXT, created REAL, "
+            "attempts INTEGER DEFAULT 0, next_at REAL, dead INTEGER DEFAULT 0, last_error TEXT)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS pending_due ON pending (dead, next_at)")
+        # Creation time of the report each patient's context document currently holds
+        conn.execute("CREATE TABLE IF NOT EXISTS latest (scope TEXT PRIMARY KEY, created REAL)")
+
+    def _connect(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=FULL")
+            self._local.conn = conn
+        return conn
+
+    def add(self, obj_id, report):
+        report_id = uuid.uuid4().hex
+        now = time.time()
+        self._connect().execute(
+            "INSERT INTO pending (report_id, obj_id, payload, created, next_at) VALUES (?, ?, ?, ?, ?)",
+            (report_id, obj_id, json.dumps(report), now, now),
+        )
+        return report_id
+
+    def claim(self, limit):
+        """Leases up to `limit` due rows, oldest first."""
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            rows = conn.execute(
+                "SELECT report_id, obj_id, payload, created, attempts FROM pending "
+                "WHERE dead = 0 AND next_at <= ? ORDER BY created LIMIT ?",
+                (now, limit),
+            ).fetchall()
+            conn.executemany(
+                "UPDATE pending SET next_at = ? WHERE report_id = ?",
+                [(now + WRITE_BEHIND_CLAIM_SECONDS, row[0]) for row in rows],
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return rows
+
+    def done(self, report_ids):
+        self._connect().executemany("DELETE FROM pending WHERE report_id = ?", [(i,) for i in report_ids])
+
+    def failed(self, rows, error):
+        now = time.time()
+        updates = []
+        for report_id, _, _, _, attempts in rows:
+            attempts += 1
+            dead = int(attempts >= WRITE_BEHIND_MAX_ATTEMPTS)
+            backoff = min(2 ** attempts, WRITE_BEHIND_MAX_BACKOFF)
+            updates.append((attempts, now + backoff, dead, str(error), report_id))
+        self._connect().executemany(
+            "UPDATE pending SET attempts = ?, next_at = ?, dead = ?, last_error = ? WHERE report_id = ?", updates
+        )
+
+    def latest_created(self, scope):
+        row = self._connect().execute("SELECT created FROM latest WHERE scope = ?", (scope,)).fetchone()
+        return row[0] if row else 0.0
+
+    def set_latest_created(self, scope, created):
+        self._connect().execute(
+            "INSERT INTO latest (scope, created) VALUES (?, ?) "
+            "ON CONFLICT (scope) DO UPDATE SET created = MAX(created, excluded.created)",
+            (scope, created),
+        )
+
+    def depth(self):
+        row = self._connect().execute(
+            "SELECT SUM(dead = 0), SUM(dead = 1), MIN(CASE WHEN dead = 0 THEN created END) FROM pending"
+        ).fetchone()
+        return row[0] or 0, row[1] or 0, row[2]
+
+    def next_due(self):
+        row = self._connect().execute("SELECT MIN(next_at) FROM pending WHERE dead = 0").fetchone()
+        return row[0]
+
+
+class ReportWriter:
+    """
+    Write-behind persistence for finished diagnoses. enqueue() only appends the report to the
+    durable spool, so the HTTP response does not wait on Firestore. A background task drains
+    the spool in WriteBatches, retrying failed batches with exponential back-off. Report
+    documents get their spool id as document id, so a batch replayed after a crash overwrites
+    the same documents instead of duplicating them.
+    """
+
+    def __init__(self, spool_path=WRITE_BEHIND_SPOOL):
+        self.spool = _Spool(spool_path)
+        self._db = None
+        self._task = None
+        self._wake = None
+        self._stopping = False
+        self._written = 0
+        self._failed_batches = 0
+        self._last_error = None
+
+    def start(self, db):
+        """Starts the background writer on the running loop, picking up anything left in the spool."""
+        self._db = db
+        self._stopping = False
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def enqueue(self, obj_id, report):
+        report_id = await asyncio.to_thread(self.spool.add, obj_id, report)
+        if self._wake is not None:
+            self._wake.set()
+        return report_id
+
+    async def _run(self):
+        while not self._stopping:
+            # Cleared before the spool is read, so an enqueue() landing at any point after this
+            # (even while next_due() runs below) keeps the event set and the wait returns at once
+            self._wake.clear()
+            try:
+                wrote = await self._flush_once()
+            except Exception as e:
+                print(f"Write-behind: spool error: {e}")
+                wrote = 0
+            if wrote:
+                continue
+
+            if self._stopping:
+                break
+            next_due = await asyncio.to_thread(self.spool.next_due)
+            timeout = None if next_due is None else max(0.05, next_due - time.time())
+            try:
+                await asyncio.wait_for(self._wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            # Let concurrent requests add to the same batch
+            await asyncio.sleep(WRITE_BEHIND_LINGER)
+
+    async def _flush_once(self):
+        rows = await asyncio.to_thread(self.spool.claim, WRITE_BEHIND_BATCH_SIZE)
+        if not rows:
+            return 0
+
+        batch = self._db.batch()
+        newest = {}  # patient id -> (created, data) of that patient's newest report in the batch
+        for report_id, obj_id, payload, created, _ in rows:
+            data = {
+                "patientId": obj_id,
+                # Time the diagnosis finished, not when the write-behind caught up
+                "timestamp": datetime.datetime.fromtimestamp(created, tz=datetime.timezone.utc),
+                **json.loads(payload)
+            }
+            report_ref = self._db.collection("patients").document(obj_id).collection("reports").document(report_id)
+            batch.set(report_ref, data)
+            if obj_id not in newest or created >= newest[obj_id][0]:
+                newest[obj_id] = (created, data)
+
+        # Only a patient's newest report of the batch can become their diagnosis context, and
+        # only if a newer one has not been written already (retried batches arrive out of order)
+        contexts = {}
+        for obj_id, (created, data) in newest.items():
+            scope = f"{CONTEXT_COLLECTION}/{obj_id}"
+            if created > await asyncio.to_thread(self.spool.latest_created, scope):
+                context = {"patientId": obj_id, "timestamp": data["timestamp"]}
+                context.update((field, data.get(field)) for field in CONTEXT_FIELDS)
+                batch.set(self._db.collection(CONTEXT_COLLECTION).document(obj_id), context)
+                contexts[scope] = created
+
+        try:
+            await batch.commit()
+        except Exception as e:
+            self._failed_batches += 1
+            self._last_error = str(e)
+            print(f"Write-behind: batch of {len(rows)} reports failed, will retry: {e}")
+            await asyncio.to_thread(self.spool.failed, rows, e)
+            return 0
+
+        await asyncio.to_thread(self.spool.done, [row[0] for row in rows])
+        for scope, created in contexts.items():
+            await asyncio.to_thread(self.spool.set_latest_created, scope, created)
+        self._written += len(rows)
+        return len(rows)
+
+    async def drain(self, timeout=10):
+        """Flushes whatever is due before shutdown; the rest stays in the spool for the next start."""
+        if self._db is None:
+            return
+        deadline = time.time() + timeout
+        if self._task is not None:
+            # Let a batch that is already being committed finish rather than cancelling it mid-way
+            self._stopping = True
+            self._wake.set()
+            try:
+                await asyncio.wait_for(self._task, timeout)
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                pass
+            self._task = None
+        while time.time() < deadline:
+            try:
+                if not await self._flush_once():
+                    break
+            except Exception as e:
+                print(f"Write-behind: drain stopped: {e}")
+                break
+
+    def stats(self):
+        pending, dead, oldest = self.spool.depth()
+        return {
+            "queue_depth": pending,
+            "dead_letters": dead,
+            "oldest_pending_seconds": round(time.time() - oldest, 1) if oldest else 0,
+            "written": self._written,
+            "failed_batches": self._failed_batches,
+            "last_error": self._last_error,
+        }
+
+
+report_writer = ReportWriter()
@@ -163,7 +163,7 @@ const addPatientImage = async (req, res) => {
 // Analyze skin image (Real AI via Python Service)
 const analyzeSkinImage = async (req, res) => {
     try {
-        const { patientId, imageUrl } = req.body;
+        const { patientId, imageUrl, mode } = req.body;
 
         console.log("Analyzing for patient:", patientId);
         if (imageUrl) console.log("Specific Image URL provided:", imageUrl);
@@ -175,6 +175,8 @@ const analyzeSkinImage = async (req, res) => {
         // Call Python Service
         const payload = { obj_id: patientId };
         if (imageUrl) payload.imageUrl = imageUrl;
+        // "agents" or "single"; the Python service default applies when omitted
+        if (mode) payload.mode = mode;
 
         const pythonResponse = await axios.post('http://127.0.0.1:6700/predict', payload);
 
@@ -219,6 +221,46 @@ const analyzeSkinImage = async (req, res) => {
     }
 };
 
+// Analyze skin image, streaming partial results (NDJSON) as each AI stage finishes
+const analyzeSkinImageStream = async (req, res) => {
+    try {
+        const { patientId, imageUrl, mode } = req.body;
+
+        if (!patientId) {
+            return res.status(400).json({ error: "Patient ID is required for analysis" });
+        }
+
+        const payload = { obj_id: patientId };
+        if (imageUrl) payload.imageUrl = imageUrl;
+        // "agents" or "single"; the Python service default applies when omitted
+        if (mode) payload.mode = mode;
+
+        const pythonResponse = await axios.post('http://127.0.0.1:6700/predict/stream', payload, {
+            responseType: 'stream'
+        });
+
+        res.setHeader('Content-Type', 'application/x-ndjson');
+        res.setHeader('Cache-Control', 'no-cache');
+        res.flushHeaders();
+
+        // Stop the Python pipeline if the client disconnects mid-stream
+        res.on('close', () => pythonResponse.data.destroy());
+        // Headers are already sent, so a broken upstream can only end the response
+        pythonResponse.data.on('error', (err) => {
+            console.error("Streaming analysis interrupted:", err.message);
+            res.end();
+        });
+        pythonResponse.data.pipe(res);
+
+    } catch (error) {
+        console.error("Streaming analysis failed:", error.message);
+        if (error.response) {
+            return res.status(error.response.status).json({ error: "AI Service Error" });
+        }
+        res.status(500).json({ error: "Failed to analyze image" });
+    }
+};
+
 // Delete a patient
 const deletePatient = async (req, res) => {
     try {
@@ -279,6 +321,7 @@ module.exports = {
     getPatientById,
     addPatientImage,
     analyzeSkinImage,
+    analyzeSkinImageStream,
     deletePatient,
     deletePatientImage,
     getPatientReports
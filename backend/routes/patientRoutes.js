@@ -20,6 +20,7 @@ router.post("/",
 );
 router.post("/:id/images", upload.single("image"), require("../controllers/patientController").addPatientImage);
 router.post("/analyze", require("../controllers/patientController").analyzeSkinImage);
+router.post("/analyze/stream", require("../controllers/patientController").analyzeSkinImageStream);
 router.delete("/:id/images", require("../controllers/patientController").deletePatientImage);
 router.delete("/:id", require("../controllers/patientController").deletePatient);
 router.get("/:id", getPatientById);
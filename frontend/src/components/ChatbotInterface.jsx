@@ -4,6 +4,7 @@ import { FaMicrophone, FaSearch, FaPaperPlane, FaSearchPlus, FaBolt, FaVolumeUp,
 import { IoClose } from 'react-icons/io5';
 import { RiStethoscopeFill } from 'react-icons/ri';
 import axios from 'axios';
+import { useMatch } from 'react-router-dom';
 import ReactMarkdown from 'react-markdown';
 // Import doctor illustration from assets
 import DoctorIllustration from '../assets/bot2.png';
@@ -23,6 +24,9 @@ const ChatbotInterface = () => {
     const [inputFocused, setInputFocused] = useState(false);
     const messagesEndRef = useRef(null);
     const recognitionRef = useRef(null);
+    // On a patient page, answer with that patient's diagnosis context
+    const patientMatch = useMatch('/patients/:id');
+    const patientId = patientMatch ? patientMatch.params.id : null;
 
     // Initialize speech recognition
     useEffect(() => {
@@ -154,7 +158,8 @@ const ChatbotInterface = () => {
             try {
                 const newBotMessage = await axios.post('http://localhost:6700/ans', {
                     "query": message,
-                    "deep_search": deepSearch
+                    "deep_search": deepSearch,
+                    ...(patientId && { "obj_id": patientId })
                 })
                 console.log(newBotMessage);
                 const botResponse = {